@@ -1,8 +1,20 @@
 #!/usr/bin/env python3
-import asyncio, ssl, json, time, requests, websockets, os
+import asyncio, ssl, json, time, websockets, os, re, sys, threading, queue, random
+import contextlib, contextvars, hashlib, traceback, atexit
+from collections import deque, OrderedDict
+from bisect import bisect_left
+from array import array
+import aiohttp
+from aiohttp import web
+from urllib.parse import urlsplit, quote
 import logging
+import logging.handlers
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: keine Config-Datei
+    tomllib = None
 
 # ============================================================
 # ✅ FIX / ERWEITERUNG: SLICER MODE + FEHLENDE ENTITÄTEN (HA)
@@ -15,18 +27,7 @@ from paho.mqtt.enums import CallbackAPIVersion
 #   der bestehenden Struktur (nur ergänzt/erweitert).
 # ============================================================
 PANDA_VERSION = "v1.9.1"
-last_reported_mode = None
-mode_change_hint = ""
-heating_locked = False
-global_lock = False  # NEU: Sicherheits-Sperre für alle Modi
-global_heating_state = 20.0
-last_switch_time = 0
-bed_sensor_error = False
-bind_confirmed = False
-bind_warning_shown = False
 # --- POWER CONFIRM (gegen ON->OFF "Bounce") ---
-desired_power_state = None # None / True / False
-power_pending_until = 0.0
 POWER_CONFIRM_TIMEOUT = 6.0 # Sekunden warten, bis WS "work_on" nachzieht
 # ==========================================
 # KONFIGURATION - BITTE HIER ANPASSEN
@@ -35,10 +36,55 @@ POWER_CONFIRM_TIMEOUT = 6.0 # Sekunden warten, bis WS "work_on" nachzieht
 DEBUG = False
 # Logging: True speichert alle Ereignisse (Verbindungen, Fehler, Sync) in 'panda_debug.log'.
 DEBUG_TO_FILE = True
+# Logging: Rotation von 'panda_debug.log' - "size" (bei LOG_FILE_MAX_MB) oder "midnight" (täglich).
+LOG_ROTATE = "size"
+# Logging: max. Dateigröße in MB ("size") und Anzahl alter Dateien (panda_debug.log.1, .2, ...).
+LOG_FILE_MAX_MB = 5
+LOG_FILE_BACKUPS = 3
+# Logging: True schreibt eine JSON-Zeile pro Ereignis (ts, key, msg) statt Text.
+LOG_JSON = False
+# Logging: gleiche Meldung (Zahlen ignoriert) max. so oft pro LOG_RATE_WINDOW Sek., der Rest wird gezählt. 0 = aus.
+LOG_RATE_LIMIT = 5
+LOG_RATE_WINDOW = 60
+# Trace: Dateiname (z.B. "panda_trace.jsonl") → alle Ein-/Ausgänge werden für Fehlersuche/Replay angehängt. Leer = aus.
+TRACE_FILE = ""
 # Schaltschwelle: Temperatur muss um diesen Wert unter 'Soll' fallen, bevor wieder geheizt wird.
 HYSTERESE = 1.5
 # Schutzzeit: Mindestpause (in Sek.) zwischen zwei Schaltvorgängen, um die Hardware zu schonen.
 MIN_SWITCH_TIME = 10
+# Regel-Modus (Auto / Manuell / Dry):
+# - "hysterese" => An/Aus über HYSTERESE + MIN_SWITCH_TIME (wie bisher)
+# - "pid"       => PID mit Anti-Windup, Stellgröße wird zeitproportional im CONTROL_WINDOW geschaltet
+# - "tpc"       => zeitproportional: Stellgröße = Abstand zum Soll / TPC_BAND (P-Regler ohne Integral)
+CONTROL_MODE = "hysterese"
+# PID / TPC: Taktfenster in Sek. (An- und Aus-Zeit im Fenster sind nie kürzer als MIN_SWITCH_TIME).
+CONTROL_WINDOW = 60
+# PID: Verstärkungen (Stellgröße 0..1 pro °C Abweichung, pro °C·Sek., pro °C/Sek.).
+PID_KP = 0.15
+PID_KI = 0.002
+PID_KD = 0.0
+# TPC: so viele °C unter Soll wird voll geheizt, darüber linear weniger.
+TPC_BAND = 5.0
+# Aufheiz-Statistik: nur Heizphasen, die mind. so viele °C unter Soll starten (nicht jeder Hysterese-Zyklus).
+HEATUP_MIN_DELTA = 5.0
+# Aufheiz-Statistik: nach Erreichen des Solls so viele Sek. das Überschwingen beobachten (<prefix>/heatup).
+HEATUP_SETTLE_TIME = 300
+# Verlauf: so viele Regel-Schritte bleiben im Speicher (Ringpuffer, fester Speicher ~22 Byte pro Eintrag).
+HISTORY_SIZE = 43200
+# Verlauf: max. Anzahl Buckets pro Abfrage über <prefix>/history/get.
+HISTORY_MAX_BUCKETS = 500
+# Regelung: rechnet sofort bei neuen Werten (Kammer, Bett, Soll, Modus, Lock) neu, ohne Änderung spätestens alle X Sek. (min. 0.5)
+CONTROL_HEARTBEAT = 2
+# Panda Touch push_status:
+# - "delta" => nur wenn sich ein gemeldeter Wert ändert (quantisiert) + Keepalive alle PANDA_REPORT_KEEPALIVE Sek.
+# - "full"  => bei jedem neuen Regel-Stand + spätestens alle PANDA_REPORT_HEARTBEAT Sek. (wie bisher)
+PANDA_REPORT_MODE = "full"
+# Panda Touch ("full"): push_status spätestens alle X Sek.
+PANDA_REPORT_HEARTBEAT = 2
+# Panda Touch ("delta"): ohne Änderung trotzdem alle X Sek. ein Report (hält die Verbindung am Leben).
+PANDA_REPORT_KEEPALIVE = 10
+# Panda Touch: Temperaturen werden auf diese Schrittweite (°C) gerundet, damit Sensor-Rauschen nicht als Änderung zählt.
+PANDA_REPORT_TEMP_STEP = 0.5
 # MQTT Broker Adresse: Die IP-Adresse deines Home Assistant oder MQTT-Servers.
 MQTT_BROKER = "192.168.x.xxx"
 # MQTT Benutzername: In HA oder anderer Broker.
@@ -52,11 +98,26 @@ MQTT_PASS = "xxxxxx"
 # - sensor.panda_breath_mod_slicer_target_temp
 # Darum MUSS der Prefix "panda_breath_mod" sein, sonst passt HA/YAML nicht.
 MQTT_TOPIC_PREFIX = "panda_breath_mod"
+# MQTT Betriebsart:
+# - "asyncio" => der MQTT Socket läuft direkt im Event Loop (kein Extra-Thread, Befehle ohne Thread-Wechsel)
+# - "thread"  => paho loop_start() Hintergrund-Thread (Fallback, wie bisher)
+MQTT_LOOP_MODE = "asyncio"
+# MQTT Keyframe: Status-Topics werden nur bei Änderung gesendet, alle X Sek. einmal komplett (Resync). 0 = aus.
+MQTT_KEYFRAME_INTERVAL = 300
 
 # Host IP: Die statische IP-Adresse des Rechners, auf dem dieses Skript läuft.
 HOST_IP = "192.168.x.xxx"
 # Panda IP: Die IP-Adresse deine Heuzung im WLAN.
 PANDA_IP = "192.168.x.xxx"
+# Panda Befehle: max. Wartezeit (Sek.) auf das Echo (settings) eines Befehls, danach geht es trotzdem weiter.
+PANDA_ACK_TIMEOUT = 1.0
+# Panda Befehle ohne Echo (nur isrunning): feste Pause (Sek.) bis zum nächsten Befehl statt auf das Echo zu warten.
+PANDA_CMD_GAP = 0.2
+# Panda WS Reconnect: Wartezeit beginnt bei MIN Sek. und verdoppelt sich bis MAX (mit Zufallsanteil gegen Reconnect-Stürme).
+PANDA_WS_BACKOFF_MIN = 1
+PANDA_WS_BACKOFF_MAX = 60
+# Panda WS Reconnect: erst nach so vielen Sek. stabiler Verbindung beginnt das Backoff wieder bei MIN.
+PANDA_WS_STABLE_TIME = 30
 # Seriennummer: Die SN deines Druckers (ist Fake, nicht anfassen wird vom Emulator gebraucht!).
 PRINTER_SN = "01P00A123456789"
 # Access Code: Der Sicherheitscode deines Druckers für die WebSocket-Verbindung. (Auch nicht anfassen!)
@@ -65,6 +126,21 @@ ACCESS_CODE = "01P00A12"
 HA_URL = "http://192.168.x.xxx:8123/api/states/sensor.ks1c_bed_temperature"
 # HA Token: Ein 'Long-Lived Access Token' (erstellt im HA-Profil ganz unten).
 HA_TOKEN = "eyJhbGciOiJIUzI1Ni............................................"
+# Bett-Sensor Quelle:
+# - "ha_rest" => HA REST API (HA_URL) wird in jedem Zyklus abgefragt (Standard, wie bisher)
+# - "ha_ws"   => eine HA WebSocket Verbindung, Werte kommen per Push (state_changed) sofort an
+# - "moonraker" => heater_bed direkt aus der Moonraker WebSocket Subscription (ohne HA, siehe MOONRAKER_WS)
+BED_SENSOR_SOURCE = "ha_rest"
+# HA WebSocket: Ping-Intervall (Sek.), damit eine tote Verbindung schnell erkannt wird.
+HA_WS_PING_INTERVAL = 10
+# HA WebSocket: Ohne Lebenszeichen nach so vielen Sek. gilt die Subscription als veraltet ("stale").
+HA_WS_STALE_TIMEOUT = 30
+# HA WebSocket: True = bei veralteter Subscription auf REST (HA_URL) zurückfallen, False = Sensorfehler melden.
+HA_WS_REST_FALLBACK = True
+# Bett-Sensor: Abfrage-Intervall (Sek.) des gemeinsamen Sensor-Tasks (einer für alle Panda Verbindungen).
+BED_POLL_INTERVAL = 2
+# Bett-Sensor: Nach so vielen Sek. ohne erfolgreiche Messung gilt der Wert als Fehler.
+BED_MAX_AGE = 10
 
 # ============================================================
 # ✅ SLICER MODE (NEU)
@@ -74,47 +150,127 @@ HA_TOKEN = "eyJhbGciOiJIUzI1Ni............................................"
 # sucht M191 Sxx / M141 Sxx und setzt slicer_soll.
 # ============================================================
 PRINTER_IP = "192.168.x.xxx"
+# Moonraker Anbindung:
+# - False => print_stats wird alle 5 Sek. per HTTP abgefragt (wie bisher)
+# - True  => eine Moonraker WebSocket Verbindung (printer.objects.subscribe), Druckstart wird sofort erkannt
+MOONRAKER_WS = False
+# Gcode Scan: so viele Bytes vom Dateianfang werden blockweise gelesen (Abbruch beim ersten Treffer, wie bisher ~50 KB).
+GCODE_SCAN_HEAD_BYTES = 50001
+# Gcode Scan: so viele Bytes vom Dateiende (Config-Block von OrcaSlicer). 0 = Ende nicht lesen.
+GCODE_SCAN_TAIL_BYTES = 65536
+# Gcode Scan: Blockgröße pro Lesevorgang (Bytes).
+GCODE_SCAN_CHUNK = 4096
+# Gcode Cache: erkannte Kammer-Temperaturen pro Datei (Name + Moonraker modified/size) auf der Platte merken.
+GCODE_CACHE_FILE = "panda_gcode_cache.json"
+# Gcode Cache: max. Anzahl Dateien (älteste zuerst raus). 0 = aus.
+GCODE_CACHE_SIZE = 200
+# Vorheizen: so viele Sek. bevor der nächste Job der Moonraker Warteschlange (job_queue) voraussichtlich startet,
+# heizt die Kammer auf dessen Slicer-Temperatur (M191/M141), falls höher als das aktuelle Soll. 0 = aus (z.B. 900).
+PREHEAT_LEAD = 0
+# Vorheizen: Abfrage-Intervall (Sek.) der Warteschlange (min. 5).
+PREHEAT_POLL_INTERVAL = 30
+# Vorheizen: Sicherheits-Abbruch, wenn der Job so viele Sek. nach Vorheiz-Start immer noch nicht läuft.
+PREHEAT_MAX_TIME = 3600
+
+# HTTP Pool: max. gleichzeitige HTTP Requests (HA + Moonraker zusammen), Rest wartet in der Queue.
+HTTP_MAX_CONCURRENT = 4
+# HTTP Pool: max. offene Keep-Alive Verbindungen pro Host.
+HTTP_LIMIT_PER_HOST = 2
+# HTTP Pool: Intervall (Sek.) für die Pool-Statistik auf <prefix>/http_stats. 0 = aus.
+HTTP_STATS_INTERVAL = 60
+# Metriken: Port für den lokalen Prometheus Endpunkt (http://<METRICS_BIND>:<Port>/metrics). 0 = aus.
+METRICS_PORT = 9108
+# Metriken: Adresse, an die der Endpunkt gebunden wird ("127.0.0.1" = nur lokal, "0.0.0.0" = ganzes Netz).
+METRICS_BIND = "127.0.0.1"
+# Metriken: zusätzlich alle X Sek. als JSON auf <prefix>/metrics. 0 = aus.
+METRICS_MQTT_INTERVAL = 0
+# Loop-Lag Monitor: Messintervall in Sek. (Verspätung des Event Loops → Metrik panda_loop_lag_seconds). 0 = aus.
+LOOP_LAG_INTERVAL = 0.5
+# Loop-Lag Monitor: hängt der Loop länger als diese Sek., wird der aktuelle Stack geloggt.
+LOOP_LAG_THRESHOLD = 0.25
+# Loop-Lag Monitor: so viele Stack-Ebenen (die innersten) kommen ins Log.
+LOOP_LAG_STACK_DEPTH = 8
+# Profiler (<prefix>/profile/start mit Sekunden): Abtastintervall in Sek. und max. Dauer pro Lauf.
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 60
 # ==========================================
 
-# current_data nutzt jetzt die exakten Namen aus der Hardware (filament_temp/timer)
-current_data = {
-    "kammer_soll": 0.0,
-    "kammer_ist": 0.0,
-    "bett_limit": 50.0,
-    "filtertemp": 30.0,
-    "filament_temp": 45,
-    "filament_timer": 3,
-
-    # ========================================================
-    # ✅ SLICER MODE STATE (NEU)
-    # --------------------------------------------------------
-    # slicer_priority_mode:
-    #    - True  => Slicer-Wert hat Vorrang (bei erkanntem M191/M141)
-    #    - False => HA / Panda Setting (soll) hat Vorrang
-    #
-    # slicer_soll:
-    #    - letzter erkannter Wert aus dem Gcode (nur Anzeige)
-    #
-    # last_analyzed_file:
-    #    - damit wir pro Datei nur einmal analysieren
-    # ========================================================
-    "slicer_priority_mode": False,
-    "slicer_soll": 0.0,
-    "last_analyzed_file": ""
-}
+# ==========================================
+# MULTI-DEVICE (optional)
+# ------------------------------------------
+# Leer = Einzelbetrieb mit den Werten oben (PANDA_IP, PRINTER_SN, HA_URL, ...).
+# Pro Eintrag ein Panda Breath + Drucker. Nicht angegebene Felder übernehmen
+# die Werte oben. Alle Geräte teilen sich MQTT Client, HTTP Pool und Event Loop.
+# Jeder Panda braucht eine EIGENE (Fake-)SN und einen eigenen MQTT Präfix.
+# DEVICES = [
+#     {"name": "ks1c", "panda_ip": "192.168.1.50", "printer_sn": "01P00A123456789",
+#      "printer_ip": "192.168.1.60", "ha_url": "http://192.168.1.10:8123/api/states/sensor.ks1c_bed_temperature"},
+#     {"name": "voron", "panda_ip": "192.168.1.51", "printer_sn": "01P00A000000002",
+#      "printer_ip": "192.168.1.61", "mqtt_prefix": "panda_breath_mod_voron", "bed_sensor_source": "moonraker"},
+# ]
+# Weitere Felder: access_code, bed_sensor_source, moonraker_ws
+DEVICES = []
+
+# Config-Datei (TOML, optional): gleiche Namen wie oben (z.B. HYSTERESE = 2.0, [[DEVICES]] ...) überschreiben die Werte
+# in diesem Skript. Änderungen werden im Betrieb übernommen: Regel-Werte sofort, geänderte Verbindungen einzeln neu.
+CONFIG_FILE = "panda_config.toml"
+# Config-Datei: Prüfintervall (Sek.) auf Änderungen. 0 = nur beim Start lesen.
+CONFIG_WATCH_INTERVAL = 2
+# ==========================================
+
+# ============================================================
+# ✅ CONFIG-DATEI (START)
+# ------------------------------------------------------------
+# Die Werte im Skript sind die Standards (CONFIG_DEFAULTS), die
+# Datei überschreibt sie. Nur bekannte Namen mit passendem Typ
+# werden übernommen. Hot Reload: siehe config_watch_loop.
+# ============================================================
+CONFIG_FIXED = ("CONFIG_FILE", "CONFIG_WATCH_INTERVAL")
+CONFIG_DEFAULTS = {k: v for k, v in globals().items() if k.isupper() and k not in CONFIG_FIXED}
+
+def read_config_mtime():
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except FileNotFoundError:
+        return None
+
+def read_config_file():
+    """CONFIG_FILE lesen → Dict (fehlt die Datei → leer)."""
+    if read_config_mtime() is None:
+        return {}
+    if tomllib is None:
+        raise RuntimeError("tomllib fehlt (Python >= 3.11 nötig)")
+    with open(CONFIG_FILE, "rb") as f:
+        return tomllib.load(f)
+
+def config_overrides(data):
+    """→ (gültige Werte, Fehlertexte)."""
+    ok, errors = {}, []
+    for k, v in data.items():
+        if k not in CONFIG_DEFAULTS:
+            errors.append(f"{k}: unbekannt")
+            continue
+        cur = CONFIG_DEFAULTS[k]
+        numeric = isinstance(cur, (int, float)) and not isinstance(cur, bool)
+        if numeric and isinstance(v, (int, float)) and not isinstance(v, bool):
+            ok[k] = v
+        elif type(v) is type(cur):
+            ok[k] = v
+        else:
+            errors.append(f"{k}: {type(cur).__name__} erwartet")
+    return ok, errors
+
+try:
+    config_mtime = read_config_mtime()
+    config_startup, config_errors = config_overrides(read_config_file())
+except (OSError, ValueError, RuntimeError) as e:
+    raise SystemExit(f"❌ {CONFIG_FILE}: {e}")
+globals().update(config_startup)
 
-ha_memory = {"kammer_soll": 30.0, "bett_limit": 50.0}
-global_heating_state = 20.0
-last_switch_time = 0
-last_ha_change = 0
-panda_ws = None
 main_loop = None
 terminal_cleared = False
-# Merkt sich den letzten vollständigen WS-Settings-Stand
-last_reported_mode = None
-mode_change_hint = ""
-last_ws_settings = {}
-power_forced_off = False # Ergänzt für Logik-Vollständigkeit
+replay_active = False
+ha_ws_tasks = []
 
 # ============================================================
 # --- LOGGING SETUP (DEBUG / CRITICAL Umschaltbar) ---
@@ -131,27 +287,117 @@ logging.basicConfig(
 #logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 #logging.getLogger("websockets").setLevel(logging.CRITICAL)
 
+# ============================================================
+# ✅ LOG PIPELINE (Queue → Hintergrund-Thread → Datei/Konsole)
+# ------------------------------------------------------------
+# log_event legt nur einen Record in eine Queue, Datei-Schreiben
+# (mit Rotation) und Konsole laufen im QueueListener Thread, nie
+# im Event Loop. Pro Record entscheiden to_file / to_console,
+# wohin er geht. Sich wiederholende Meldungen (gleicher Text,
+# Zahlen egal) werden nach LOG_RATE_LIMIT pro Fenster nur noch
+# gezählt und am Fensterende als Summe gemeldet.
+# ============================================================
 file_logger = logging.getLogger("PandaFullLog")
 file_logger.propagate = False
 file_logger.setLevel(logging.INFO)
 
+class LogJsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({"ts": self.formatTime(record), "key": record.key, "msg": record.getMessage()}, ensure_ascii=False)
+
+class LogTargetFilter(logging.Filter):
+    def __init__(self, attr):
+        super().__init__()
+        self.attr = attr
+
+    def filter(self, record):
+        return getattr(record, self.attr, False)
+
+log_handlers = []
 if DEBUG_TO_FILE:
-    f_handler = logging.FileHandler("panda_debug.log")
+    if LOG_ROTATE == "midnight":
+        f_handler = logging.handlers.TimedRotatingFileHandler("panda_debug.log", when="midnight", backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+    else:
+        f_handler = logging.handlers.RotatingFileHandler("panda_debug.log", maxBytes=int(LOG_FILE_MAX_MB * 1024 * 1024), backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
     f_handler.setFormatter(
-        logging.Formatter("%(asctime)s - %(message)s")
+        LogJsonFormatter() if LOG_JSON else logging.Formatter("%(asctime)s - %(message)s")
     )
-    file_logger.addHandler(f_handler)
-    
+    f_handler.addFilter(LogTargetFilter("to_file"))
+    log_handlers.append(f_handler)
+
+c_handler = logging.StreamHandler(sys.stdout)
+c_handler.setFormatter(logging.Formatter(" INFO:PandaDebug:%(message)s"))
+c_handler.addFilter(LogTargetFilter("to_console"))
+log_handlers.append(c_handler)
+
+log_queue = queue.SimpleQueue()
+file_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)  # Rest der Queue beim Beenden noch schreiben
+
+LOG_KEY_NUMBERS = re.compile(r"\d+(?:\.\d+)?")
+
+class LogRateLimiter:
+    # log_event kommt auch aus Watchdog-/Profiler- und paho-Thread → Lock
+    def __init__(self):
+        self.windows = {}  # key → [Fensterstart, Anzahl, unterdrückt]
+        self.suppressed_total = 0
+        self._lock = threading.Lock()
+
+    def allow(self, key, now):
+        report = 0
+        with self._lock:
+            w = self.windows.get(key)
+            if w is None or now - w[0] >= LOG_RATE_WINDOW:
+                if w is not None:
+                    report = w[2]
+                self.windows[key] = [now, 1, 0]
+                allowed = True
+            else:
+                w[1] += 1
+                allowed = w[1] <= LOG_RATE_LIMIT
+                if not allowed:
+                    w[2] += 1
+                    self.suppressed_total += 1
+        if report:
+            self._report(key, report)
+        return allowed
+
+    def flush(self, now):
+        # Abgelaufene Fenster melden + wegräumen (hält das Dict klein)
+        reports = []
+        with self._lock:
+            for key, w in list(self.windows.items()):
+                if now - w[0] >= LOG_RATE_WINDOW:
+                    if w[2]:
+                        reports.append((key, w[2]))
+                    del self.windows[key]
+        for key, n in reports:
+            self._report(key, n)
+
+    def _report(self, key, n):
+        _log_emit(f"[LOG] {n}x unterdrückt in {LOG_RATE_WINDOW}s: {key}", True, "LOG")
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(LOG_RATE_WINDOW)
+            self.flush(time.monotonic())
+
+log_limiter = LogRateLimiter()
+
 # --- LOGGING FUNKTION ---
 def log_event(msg, force_console=False):
+    key = LOG_KEY_NUMBERS.sub("#", msg)[:120]
+    if LOG_RATE_LIMIT > 0 and not log_limiter.allow(key, time.monotonic()):
+        return
+    _log_emit(msg, force_console, key)
 
-    # 1️⃣ Datei Logging
-    if DEBUG_TO_FILE:
-        file_logger.info(msg)
-
-    # 2️⃣ Konsole nur bei DEBUG oder Force
-    if DEBUG or force_console:
-        print(f" INFO:PandaDebug:{msg}")
+def _log_emit(msg, force_console, key):
+    # 1️⃣ Datei Logging  2️⃣ Konsole nur bei DEBUG oder Force
+    to_file, to_console = DEBUG_TO_FILE, DEBUG or force_console
+    if to_file or to_console:
+        file_logger.info(msg, extra={"to_file": to_file, "to_console": to_console, "key": key})
             
 # --- HELPER ---
 def safe_float(v, default=0.0):
@@ -160,126 +406,1490 @@ def safe_float(v, default=0.0):
     except Exception:
         return default
 
-# ✅ SLICER PARSER (OPTIMIERT: Nutzt run_in_executor gegen Blockaden)
-async def slicer_auto_parser():
-    loop = asyncio.get_event_loop()
+# Latenz-Messwerte (ms) der letzten N Ereignisse → kleine Statistik für MQTT
+class LatencyStats:
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def record(self, ms):
+        self.samples.append(ms)
+
+    def summary(self):
+        s = sorted(self.samples)
+        if not s:
+            return {"n": 0}
+        return {
+            "n": len(s),
+            "last_ms": round(self.samples[-1], 2),
+            "avg_ms": round(sum(s) / len(s), 2),
+            "p95_ms": round(s[min(len(s) - 1, int(len(s) * 0.95))], 2),
+            "max_ms": round(s[-1], 2)
+        }
+
+# Startzeiten (Sek. seit Skript-Start nach den Imports): wann war was zum ersten Mal bereit.
+# Beim ersten push_status an den Panda Touch → Log + <prefix>/startup (retained).
+class StartupTimer:
+    def __init__(self):
+        self.t0 = time.monotonic()
+        self.marks = {}
+
+    def mark(self, name):
+        if name in self.marks:
+            return
+        self.marks[name] = round(time.monotonic() - self.t0, 3)
+        log_event(f"[STARTUP] {name} nach {self.marks[name]:.2f}s")
+        if name == "first_push_status":
+            log_event(f"[STARTUP] Erster push_status nach {self.marks[name]:.2f}s: {json.dumps(self.marks)}", force_console=True)
+            # über state_pub: ist MQTT noch nicht da, kommt es mit dem Resync nach dem Connect
+            state_pub.publish(f"{MQTT_TOPIC_PREFIX}/startup", json.dumps(self.marks), retain=True)
+
+startup = StartupTimer()
+
+# ============================================================
+# ✅ METRIKEN (Zähler / Gauges / Latenz-Histogramme)
+# ------------------------------------------------------------
+# Im Hot-Path nur ein Dict-Zugriff + Addition (kein Lock: alles
+# läuft im Event Loop, im paho Thread-Modus reicht der GIL für
+# die Zähler). Histogramme zählen pro Bucket (Sek.), kumuliert
+# wird erst bei der Ausgabe.
+# Ausgabe: Prometheus Textformat auf METRICS_PORT (/metrics),
+# optional als JSON auf <prefix>/metrics.
+# ============================================================
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Metric:
+    def __init__(self, kind, name, help, labels=("device",), buckets=METRIC_BUCKETS):
+        self.kind, self.name, self.help, self.labels = kind, name, help, labels
+        self.buckets = buckets
+        self.values = {}  # Label-Werte (Tupel) → Zahl bzw. [Bucket-Zähler..., +Inf, Summe]
+
+    def inc(self, *lv, n=1):
+        self.values[lv] = self.values.get(lv, 0) + n
+
+    def set(self, value, *lv):
+        self.values[lv] = value
+
+    def observe(self, seconds, *lv):
+        v = self.values.get(lv)
+        if v is None:
+            v = self.values[lv] = [0] * (len(self.buckets) + 2)
+        v[bisect_left(self.buckets, seconds)] += 1
+        v[-1] += seconds
+
+    def _labels(self, lv, extra=""):
+        parts = [f'{k}="{v}"' for k, v in zip(self.labels, lv)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for lv, v in list(self.values.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self._labels(lv)} {v}")
+                continue
+            total = 0
+            for le, n in zip(self.buckets + ("+Inf",), v):
+                total += n
+                lines.append(f"{self.name}_bucket{self._labels(lv, 'le=' + json.dumps(str(le)))} {total}")
+            lines.append(f"{self.name}_sum{self._labels(lv)} {round(v[-1], 6)}")
+            lines.append(f"{self.name}_count{self._labels(lv)} {total}")
+        return lines
+
+    def as_json(self):
+        out = {}
+        for lv, v in list(self.values.items()):
+            key = ",".join(lv) or "_"
+            if self.kind == "histogram":
+                n = sum(v[:-1])
+                out[key] = {"count": n, "avg_ms": round(v[-1] / n * 1000, 2) if n else None}
+            else:
+                out[key] = v
+        return out
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.started = time.time()
+
+    def add(self, kind, name, help, **kw):
+        m = Metric(kind, name, help, **kw)
+        self.metrics.append(m)
+        return m
+
+    def collect(self):
+        # Werte, die erst beim Abruf berechnet werden
+        self.uptime.set(round(time.time() - self.started, 1))
+        self.log_suppressed.set(log_limiter.suppressed_total)
+        for dev in devices:
+            self.ws_uptime.set(ws_link_snapshot(dev)["uptime_s"], dev.name)
+
+    def prometheus(self):
+        self.collect()
+        lines = []
+        for m in self.metrics:
+            lines += m.prometheus()
+        return "\n".join(lines) + "\n"
+
+    def as_json(self):
+        self.collect()
+        return {m.name: m.as_json() for m in self.metrics}
+
+metrics = MetricsRegistry()
+metrics.uptime = metrics.add("gauge", "panda_uptime_seconds", "Laufzeit des Skripts", labels=())
+metrics.ha_fetch = metrics.add("histogram", "panda_ha_fetch_seconds", "Dauer fetch_ha (HA REST Bett-Sensor)")
+metrics.ha_fetch_errors = metrics.add("counter", "panda_ha_fetch_errors_total", "Fehlgeschlagene fetch_ha Aufrufe")
+metrics.ws_connects = metrics.add("counter", "panda_ws_connects_total", "Aufgebaute Panda WS Verbindungen")
+metrics.ws_errors = metrics.add("counter", "panda_ws_errors_total", "Abgebrochene Panda WS Verbindungen")
+metrics.gcode_cache = metrics.add("counter", "panda_gcode_cache_total", "Gcode Analysen nach Ergebnis (hits/metadata/misses)", labels=("result",))
+metrics.ws_uptime = metrics.add("gauge", "panda_ws_uptime_seconds", "Dauer der aktuellen Panda WS Verbindung")
+metrics.ws_connected = metrics.add("gauge", "panda_ws_connected", "Panda WS aktuell verbunden (0/1)")
+metrics.mqtt_messages = metrics.add("counter", "panda_mqtt_messages_total", "Von on_mqtt_message verarbeitete Nachrichten")
+metrics.report_drain = metrics.add("histogram", "panda_report_drain_seconds", "Blockierzeit writer.drain() beim push_status")
+metrics.loop_lag = metrics.add("histogram", "panda_loop_lag_seconds", "Verspätung des Event Loops (Scheduling Delay)", labels=())
+metrics.log_suppressed = metrics.add("counter", "panda_log_suppressed_total", "Durch das Log-Limit unterdrückte Meldungen", labels=())
+metrics.loop_stalls = metrics.add("counter", "panda_loop_stalls_total", "Loop-Blockaden über LOOP_LAG_THRESHOLD", labels=())
+
+async def metrics_http_server():
+    async def handle(request):
+        return web.Response(
+            body=metrics.prometheus().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_BIND, METRICS_PORT).start()
+    except OSError as e:
+        # Port belegt / Adresse ungültig → ohne Endpunkt weiter (Regelung hat Vorrang)
+        log_event(f"[METRICS-ERR] {METRICS_BIND}:{METRICS_PORT}: {e}", force_console=True)
+        await runner.cleanup()
+        return
+    log_event(f"[METRICS] http://{METRICS_BIND}:{METRICS_PORT}/metrics")
+
+async def metrics_mqtt_reporter():
     while True:
+        await asyncio.sleep(METRICS_MQTT_INTERVAL)
+        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/metrics", json.dumps(metrics.as_json()))
+
+# ============================================================
+# ✅ EVENT LOOP LAG MONITOR + SAMPLING PROFILER
+# ------------------------------------------------------------
+# monitor() (Task) misst die Verspätung eines sleep() und setzt
+# einen Herzschlag. Der Watchdog-Thread merkt, wenn der Herzschlag
+# länger als LOOP_LAG_THRESHOLD ausbleibt, und loggt Task + Stack,
+# in dem der Loop gerade hängt (sys._current_frames) - einmal pro
+# Blockade. Profiler (opt-in): <prefix>/profile/start mit Sekunden
+# → ein Thread tastet den Loop-Stack alle PROFILE_INTERVAL ab,
+# Ergebnis (Eigen-/Gesamtanteil pro Funktion) auf <prefix>/profile.
+# ============================================================
+class LoopWatchdog:
+    def __init__(self):
+        self.loop_thread = None
+        self.heartbeat = 0.0
+        self.stalled_since = None
+        self.profiling = threading.Lock()
+
+    async def monitor(self):
+        self.heartbeat = time.monotonic()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            metrics.loop_lag.observe(max(0.0, now - t0 - LOOP_LAG_INTERVAL))
+            self.heartbeat = now
+
+    def _watch(self):
+        while True:
+            time.sleep(LOOP_LAG_INTERVAL / 2)
+            hb = self.heartbeat
+            lag = time.monotonic() - hb - LOOP_LAG_INTERVAL
+            if lag > LOOP_LAG_THRESHOLD and self.stalled_since != hb:
+                self.stalled_since = hb
+                metrics.loop_stalls.inc()
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = "".join(traceback.format_stack(frame)[-LOOP_LAG_STACK_DEPTH:]) if frame else ""
+                try:
+                    task = asyncio.current_task(main_loop)
+                except RuntimeError:
+                    task = None
+                where = task.get_name() if task else "Callback"
+                log_event(f"[LOOP-LAG] Event Loop blockiert seit {lag + LOOP_LAG_INTERVAL:.2f}s ({where}):\n{stack}", force_console=True)
+            elif self.stalled_since is not None and hb != self.stalled_since:
+                log_event(f"[LOOP-LAG] Event Loop wieder frei nach {hb - self.stalled_since:.2f}s", force_console=True)
+                self.stalled_since = None
+
+    def start_profile(self, dev, seconds):
+        if not self.profiling.acquire(blocking=False):
+            log_event("[PROFILE] Läuft bereits", force_console=True)
+            return
+        seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+        log_event(f"[PROFILE] Start für {seconds:.1f}s", force_console=True)
+        threading.Thread(target=self._profile, args=(dev, seconds), name="loop-profiler", daemon=True).start()
+
+    def _profile(self, dev, seconds):
         try:
-            # OPTIMIERUNG: requests in Thread auslagern, damit das Hauptskript (Heartbeat) nicht stoppt
-            def fetch_moonraker():
-                return requests.get(f"http://{PRINTER_IP}/printer/objects/query?print_stats", timeout=2).json()
-            
-            r = await loop.run_in_executor(None, fetch_moonraker)
+            own, total, n = {}, {}, 0
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                frame = sys._current_frames().get(self.loop_thread)
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    if not seen:
+                        own[key] = own.get(key, 0) + 1
+                    if key not in seen:
+                        seen.add(key)
+                        total[key] = total.get(key, 0) + 1
+                    frame = frame.f_back
+                n += 1
+                time.sleep(PROFILE_INTERVAL)
+
+            def top(counts):
+                return [[k, round(100 * v / n, 1)] for k, v in sorted(counts.items(), key=lambda kv: -kv[1])[:20]]
+
+            report = {"seconds": round(seconds, 1), "samples": n, "interval_ms": PROFILE_INTERVAL * 1000, "self_pct": top(own), "total_pct": top(total)}
+            log_event(f"[PROFILE] {json.dumps(report)}", force_console=True)
+            # paho im asyncio Modus ist nicht threadsicher → über den Loop senden
+            main_loop.call_soon_threadsafe(mqtt_client.publish, f"{dev.prefix}/profile", json.dumps(report))
+        finally:
+            self.profiling.release()
+
+loop_watchdog = LoopWatchdog()
+
+# ============================================================
+# ✅ DEVICE STATE (feste Felder, gehört dem Event Loop)
+# ------------------------------------------------------------
+# Ersetzt das frühere current_data Dict + lose Flags. Nur der
+# Event Loop schreibt hier rein: MQTT Befehle aus dem paho
+# Thread laufen über die CommandInbox (siehe unten).
+# snapshot() ist ein billiges Tupel, diff() vergleicht zwei
+# Stände (z.B. vor/nach einem Befehl fürs Log).
+# ============================================================
+class DeviceState:
+    __slots__ = (
+        # Werte aus der Hardware (filament_temp/timer wie im Panda WS)
+        "kammer_soll", "kammer_ist", "bett_limit", "filtertemp", "filament_temp", "filament_timer",
+        # SLICER MODE:
+        # slicer_priority_mode: True => Slicer-Wert (M191/M141) hat Vorrang, False => HA / Panda Setting
+        # slicer_soll: letzter erkannter Wert aus dem Gcode (nur Anzeige)
+        # last_analyzed_file: damit wir pro Datei nur einmal analysieren
+        # ha_soll_memory: Soll-Wert aus HA, während der Slicer Vorrang hat
+        "slicer_priority_mode", "slicer_soll", "last_analyzed_file", "ha_soll_memory",
+        # Vorheizen für den nächsten Job der Moonraker Warteschlange (0.0 = aus)
+        "preheat_target", "preheat_file",
+        # Lock / Power / Heizung
+        "global_lock", "heating_locked", "power_forced_off", "global_heating_state",
+        "desired_power_state", "power_pending_until", "last_switch_time", "last_ha_change",
+        # Diagnose
+        "bed_sensor_error", "bind_confirmed", "bind_warning_shown", "last_reported_mode",
+    )
+
+    def __init__(self):
+        self.kammer_soll = 0.0
+        self.kammer_ist = 0.0
+        self.bett_limit = 50.0
+        self.filtertemp = 30.0
+        self.filament_temp = 45
+        self.filament_timer = 3
+        self.slicer_priority_mode = False
+        self.slicer_soll = 0.0
+        self.last_analyzed_file = ""
+        self.ha_soll_memory = 30.0
+        self.preheat_target = 0.0
+        self.preheat_file = ""
+        self.global_lock = False  # Sicherheits-Sperre für alle Modi
+        self.heating_locked = False
+        self.power_forced_off = False
+        self.global_heating_state = 20.0
+        # --- POWER CONFIRM (gegen ON->OFF "Bounce") ---
+        self.desired_power_state = None  # None / True / False
+        self.power_pending_until = 0.0
+        self.last_switch_time = 0
+        self.last_ha_change = 0
+        self.bed_sensor_error = False
+        self.bind_confirmed = False
+        self.bind_warning_shown = False
+        self.last_reported_mode = None
+
+    def snapshot(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def as_dict(self):
+        return dict(zip(self.__slots__, self.snapshot()))
+
+    def diff(self, old):
+        # old = früheres snapshot() → {feld: (alt, neu)} nur für geänderte Felder
+        return {
+            f: (a, b) for f, a, b in zip(self.__slots__, old, self.snapshot()) if a != b
+        }
+
+# ============================================================
+# ✅ PANDA DEVICE (ein Objekt pro Panda Breath + Drucker)
+# ------------------------------------------------------------
+# Alles, was früher modulweite Globals waren (IPs, SN, Präfix,
+# Zustand, WS-Verbindung, Sensorwerte),
+# liegt jetzt pro Gerät. Im Einzelbetrieb gibt es genau ein
+# Gerät mit den Werten aus der Konfiguration oben.
+# ============================================================
+# DEVICES Eintrag + globale Standards → Verbindungs-Felder eines Geräts (auch für den Config Reload)
+def device_config(cfg, index):
+    name = cfg.get("name", f"panda{index + 1}")
+    return {
+        "name": name,
+        "panda_ip": cfg.get("panda_ip", PANDA_IP),
+        "sn": cfg.get("printer_sn", PRINTER_SN),
+        "access_code": cfg.get("access_code", ACCESS_CODE),
+        "printer_ip": cfg.get("printer_ip", PRINTER_IP),
+        "ha_url": cfg.get("ha_url", HA_URL),
+        # Erstes Gerät behält den Standard-Präfix (HA Entitäten / YAML bleiben gleich)
+        "prefix": cfg.get("mqtt_prefix", MQTT_TOPIC_PREFIX if index == 0 else f"{MQTT_TOPIC_PREFIX}_{name}"),
+        "bed_sensor_source": cfg.get("bed_sensor_source", BED_SENSOR_SOURCE),
+        "moonraker_ws": cfg.get("moonraker_ws", MOONRAKER_WS)
+    }
+
+class PandaDevice:
+    def __init__(self, cfg, index):
+        self.index = index
+        for key, value in device_config(cfg, index).items():
+            setattr(self, key, value)
+
+        # Zustand (nur im Event Loop verändert, siehe DeviceState / CommandInbox)
+        self.state = DeviceState()
+
+        self.panda_ws = None
+        self.cmd_queue = None  # PandaCommandQueue, wird in main() angelegt
+        self.controller = None  # ChamberController, wird in main() angelegt
+        self.heatup = None  # HeatupTracker, wird in main() angelegt
+        self.history = None  # HistoryRing, wird in main() angelegt
+        # Merkt sich den letzten vollständigen WS-Settings-Stand
+        self.last_ws_settings = {}
+        self.mode_change_hint = ""
+
+        # Sensoren / Slicer (siehe HA WS, Moonraker WS, Sensor-Producer)
+        self.ha_ws_state = {"state": None, "last_seen": 0.0, "connected": False, "fallback_active": False}
+        self.moonraker_state = {"filename": "", "print_state": "", "bed": None, "last_seen": 0.0, "connected": False}
+        self.slicer_analysis_task = None
+        self.bed_reading = {"value": None, "ts": 0.0, "error": None}
+        self.control_output = None  # letzter Report-Stand für die Panda Session (None = Sensorfehler)
+
+        # Event-gesteuerte Regelung (siehe mark_input_changed / heating_control_loop)
+        self.bed_pushed = asyncio.Event()       # HA WS / Moonraker haben einen neuen Bett-Wert
+        self.input_changed = asyncio.Event()    # irgendein Eingang der Regelung hat sich geändert
+        self.input_changed_at = None            # perf_counter der ersten noch nicht verarbeiteten Änderung
+        self.report_wakeup = asyncio.Event()    # neuer control_output → Sessions senden sofort
+        self.report_input_at = None             # Eingangs-Zeitpunkt des nächsten Reports (Latenz)
+        self.report_latency = LatencyStats()
+        self.report_latency_published = 0.0
+        self.report_stats = {"sent": 0, "suppressed": 0, "keepalive": 0}
+        self.sessions = 0                       # verbundene Panda Touch Sessions
+        self.tasks = {}                         # "ws" / "printer" → laufender Task (einzeln neu startbar)
+        # Panda WS Verbindung (siehe update_limits_from_ws / ws_link_snapshot)
+        self.ws_link = {"connected_since": None, "connects": 0, "total_uptime": 0.0, "lock_resends": 0,
+                        "lock_sent_at": 0.0, "last_error": "", "backoff_s": 0.0}
+
+    @property
+    def panda_host(self):
+        return self.panda_ip.split(":")[0]
+
+def build_devices():
+    cfgs = DEVICES or [{"name": "panda"}]
+    devs = [PandaDevice(cfg, i) for i, cfg in enumerate(cfgs)]
+
+    for attr in ("sn", "prefix", "name"):
+        values = [getattr(d, attr) for d in devs]
+        if len(set(values)) != len(values):
+            raise SystemExit(f"DEVICES: '{attr}' muss pro Gerät eindeutig sein: {values}")
+    return devs
+
+devices = build_devices()
+devices_by_sn = {d.sn: d for d in devices}
+
+def device_for_topic(topic):
+    for d in devices:
+        if topic.startswith(d.prefix + "/"):
+            return d
+    return None
+
+# ============================================================
+# ✅ TRACE (AUFZEICHNUNG FÜR FEHLERSUCHE + REPLAY)
+# ------------------------------------------------------------
+# TRACE_FILE gesetzt → jedes Ein-/Ausgangs-Ereignis wird als
+# kompakte JSON-Zeile angehängt: [t, art, gerät, daten] mit
+# t = Sek. seit Programmstart (monotonic). Jeder Start beginnt
+# mit einer Kopfzeile (Version, Startzeit, Regel-Parameter).
+# Arten: ws_in / ws_out (Panda WS), bed (Bett-Sensor), mqtt_in
+# (Befehle), slicer (Gcode Soll), ctl (Regel-Entscheidung),
+# report (push_status an den Panda), preheat (Vorheizen Warteschlange).
+# Abspielen: python3 Panda.py --replay panda_trace.jsonl
+# ============================================================
+TRACE_CONFIG_KEYS = (
+    "HYSTERESE", "MIN_SWITCH_TIME", "BED_MAX_AGE", "CONTROL_MODE",
+    "CONTROL_WINDOW", "PID_KP", "PID_KI", "PID_KD", "TPC_BAND"
+)
+# Abfragen ohne Einfluss auf den Regel-Stand → beim Abspielen überspringen
+# (würden sonst publizieren bzw. den Profiler-Thread starten)
+REPLAY_SKIP_TOPICS = ("/history/get", "/profile/start")
+
+class TraceWriter:
+    # Wie die Log Pipeline: Zeilen gehen über eine Queue, geschrieben
+    # wird im QueueListener Thread (kein Datei-I/O im Event Loop)
+    def __init__(self, path):
+        self.path = path
+        self.enabled = False
+        self.lines = 0
+        self._log = logging.getLogger("PandaTrace")
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._t0 = 0.0
+
+    def start(self):
+        if not self.path:
+            return
+        handler = logging.FileHandler(self.path, mode="a", encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_queue = queue.SimpleQueue()
+        self._log.addHandler(logging.handlers.QueueHandler(trace_queue))
+        listener = logging.handlers.QueueListener(trace_queue, handler)
+        listener.start()
+        atexit.register(listener.stop)  # Rest der Queue beim Beenden noch schreiben
+        self._t0 = time.monotonic()
+        self.enabled = True
+        self._log.info(json.dumps({
+            "trace": 1,
+            "version": PANDA_VERSION,
+            "wall": time.time(),
+            "devices": [d.name for d in devices],
+            "config": {k: globals()[k] for k in TRACE_CONFIG_KEYS}
+        }))
+        log_event(f"[TRACE] Aufzeichnung → {self.path}")
+
+    def write(self, kind, dev, data):
+        t = round(time.monotonic() - self._t0, 4)
+        # Sofort serialisieren: data kann sich danach noch ändern
+        self._log.info(json.dumps([t, kind, dev.name if dev else "*", data], separators=(",", ":")))
+        self.lines += 1
+
+tracer = TraceWriter(TRACE_FILE)
+
+def trace(kind, dev, data):
+    if tracer.enabled:
+        tracer.write(kind, dev, data)
+
+# ============================================================
+# ✅ HTTP POOL (aiohttp statt requests + Executor)
+# ------------------------------------------------------------
+# Eine gemeinsame Session für HA und Moonraker: Keep-Alive pro
+# Host (kein neuer TCP-Handshake je Zyklus), DNS-Cache, Timeout
+# pro Request und ein Limit für gleichzeitige Requests statt
+# unbegrenzter Executor-Threads.
+# ============================================================
+class HttpPool:
+    def __init__(self, max_concurrent=HTTP_MAX_CONCURRENT, limit_per_host=HTTP_LIMIT_PER_HOST):
+        self.max_concurrent = max_concurrent
+        self.limit_per_host = limit_per_host
+        self._session = None
+        self._sem = None
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "conn_new": 0,
+            "conn_reused": 0,
+            "queue_wait_ms_total": 0.0,
+            "queue_wait_ms_max": 0.0
+        }
+
+    def _get_session(self):
+        # Lazy: aiohttp Session muss im laufenden Event Loop erzeugt werden
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_conn_new)
+            trace.on_connection_reuseconn.append(self._on_conn_reused)
+
+            self._sem = asyncio.Semaphore(self.max_concurrent)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_concurrent,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=30,
+                    ttl_dns_cache=300
+                ),
+                trace_configs=[trace]
+            )
+        return self._session
+
+    async def _on_conn_new(self, session, ctx, params):
+        self.stats["conn_new"] += 1
+
+    async def _on_conn_reused(self, session, ctx, params):
+        self.stats["conn_reused"] += 1
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url, timeout=5, **kwargs):
+        session = self._get_session()
+        t0 = time.perf_counter()
+
+        async with self._sem:
+            wait_ms = (time.perf_counter() - t0) * 1000
+            self.stats["queue_wait_ms_total"] += wait_ms
+            self.stats["queue_wait_ms_max"] = max(self.stats["queue_wait_ms_max"], wait_ms)
+            self.stats["requests"] += 1
+            self.stats["in_flight"] += 1
+            try:
+                async with session.request(
+                    method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs
+                ) as resp:
+                    yield resp
+            except Exception:
+                self.stats["errors"] += 1
+                raise
+            finally:
+                self.stats["in_flight"] -= 1
+
+    async def get_json(self, url, timeout=2, headers=None):
+        async with self.request("GET", url, timeout=timeout, headers=headers) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    def snapshot(self):
+        snap = dict(self.stats)
+        total = snap["conn_new"] + snap["conn_reused"]
+        snap["reuse_ratio"] = round(snap["conn_reused"] / total, 3) if total else 0.0
+        snap["queue_wait_ms_avg"] = round(snap["queue_wait_ms_total"] / snap["requests"], 2) if snap["requests"] else 0.0
+        snap["queue_wait_ms_max"] = round(snap["queue_wait_ms_max"], 2)
+        del snap["queue_wait_ms_total"]
+        return snap
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+http_pool = HttpPool()
+
+async def http_stats_reporter():
+    while True:
+        await asyncio.sleep(HTTP_STATS_INTERVAL)
+        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/http_stats", json.dumps(http_pool.snapshot()))
+
+# ============================================================
+# ✅ BETT-SENSOR: HA REST + HA WEBSOCKET (PUSH)
+# ------------------------------------------------------------
+# REST: ein GET pro Zyklus über den HTTP Pool (Fallback, bewährt).
+# WS:   eine authentifizierte Verbindung pro HA Instanz, abonniert
+#       state_changed für die Entität aus dev.ha_url (pro Gerät eine
+#       Subscription) und hält den letzten Wert im Speicher
+#       (dev.ha_ws_state). Bleibt die Verbindung stumm (kein Event,
+#       kein Pong), gilt sie nach HA_WS_STALE_TIMEOUT als veraltet.
+# ============================================================
+async def fetch_ha(dev):
+    t0 = time.perf_counter()
+    try:
+        return await http_pool.get_json(
+            dev.ha_url,
+            headers={"Authorization": f"Bearer {HA_TOKEN}"},
+            timeout=2
+        )
+    except Exception:
+        metrics.ha_fetch_errors.inc(dev.name)
+        raise
+    finally:
+        metrics.ha_fetch.observe(time.perf_counter() - t0, dev.name)
+
+def ha_ws_endpoint(ha_url):
+    # http://host:8123/api/states/sensor.xyz → ws://host:8123/api/websocket + sensor.xyz
+    u = urlsplit(ha_url)
+    scheme = "wss" if u.scheme == "https" else "ws"
+    entity_id = u.path.rsplit("/", 1)[-1]
+    return f"{scheme}://{u.netloc}/api/websocket", entity_id
+
+async def ha_ws_sensor(uri, devs):
+    while True:
+        try:
+            async with websockets.connect(uri, ping_interval=None, max_size=None) as ws:
+                # 1️⃣ AUTH
+                await ws.recv()  # auth_required
+                await ws.send(json.dumps({"type": "auth", "access_token": HA_TOKEN}))
+                auth = json.loads(await ws.recv())
+                if auth.get("type") != "auth_ok":
+                    raise RuntimeError(f"Auth fehlgeschlagen: {auth.get('message', auth.get('type'))}")
+
+                # 2️⃣ SUBSCRIBE: state_changed nur für die Entität des Geräts (Filter läuft in HA)
+                subs = {}
+                for sub_id, dev in enumerate(devs, start=1):
+                    entity_id = ha_ws_endpoint(dev.ha_url)[1]
+                    await ws.send(json.dumps({
+                        "id": sub_id,
+                        "type": "subscribe_trigger",
+                        "trigger": {"platform": "state", "entity_id": entity_id}
+                    }))
+                    subs[sub_id] = dev
+
+                # 3️⃣ Startwert einmalig per REST holen (Trigger feuert erst bei Änderung)
+                # Fehler hier → ohne Startwert weiter, die Subscription liefert die nächste Änderung
+                for dev in devs:
+                    try:
+                        dev.ha_ws_state["state"] = (await fetch_ha(dev)).get("state")
+                    except Exception as e:
+                        log_event(f"[HA-WS-ERR] {dev.name}: Startwert per REST fehlgeschlagen: {e}")
+                    dev.ha_ws_state["last_seen"] = time.time()
+                    dev.ha_ws_state["connected"] = True
+                log_event(f"[HA-WS] Verbunden mit {uri}, {len(subs)} Subscription(s)")
+                startup.mark("ha_ws")
+
+                msg_id = len(subs) + 1
+                last_seen = time.time()
+                while True:
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout=HA_WS_PING_INTERVAL)
+                    except asyncio.TimeoutError:
+                        if (time.time() - last_seen) > HA_WS_STALE_TIMEOUT:
+                            raise RuntimeError("Keine Antwort von HA (stale)")
+                        await ws.send(json.dumps({"id": msg_id, "type": "ping"}))
+                        msg_id += 1
+                        continue
+
+                    msg = json.loads(raw)
+                    last_seen = time.time()
+                    for dev in devs:
+                        dev.ha_ws_state["last_seen"] = last_seen
+
+                    dev = subs.get(msg.get("id"))
+                    if dev is None:
+                        continue
+
+                    if msg.get("type") == "result" and not msg.get("success"):
+                        raise RuntimeError(f"Subscribe abgelehnt: {msg.get('error')}")
+
+                    if msg.get("type") == "event":
+                        to_state = msg.get("event", {}).get("variables", {}).get("trigger", {}).get("to_state") or {}
+                        dev.ha_ws_state["state"] = to_state.get("state")
+                        dev.bed_pushed.set()
+
+        except Exception as e:
+            log_event(f"[HA-WS-ERR] {e}")
+
+        for dev in devs:
+            dev.ha_ws_state["connected"] = False
+        await asyncio.sleep(5)
+
+async def read_bed_temperature(dev):
+    """Liefert die Bett-Temperatur oder wirft eine Exception (→ bed_sensor_error)."""
+    if dev.bed_sensor_source == "moonraker":
+        if not dev.moonraker_state["connected"] or dev.moonraker_state["bed"] is None:
+            raise RuntimeError("Moonraker WebSocket nicht verbunden")
+        return float(dev.moonraker_state["bed"])
+
+    if dev.bed_sensor_source == "ha_ws":
+        age = time.time() - dev.ha_ws_state["last_seen"]
+        if dev.ha_ws_state["connected"] and age <= HA_WS_STALE_TIMEOUT:
+            if dev.ha_ws_state["fallback_active"]:
+                log_event(f"[HA-WS] {dev.name}: Subscription wieder aktuell, REST Fallback beendet")
+                dev.ha_ws_state["fallback_active"] = False
+            return float(dev.ha_ws_state["state"])
+
+        if not HA_WS_REST_FALLBACK:
+            raise RuntimeError(f"HA WebSocket veraltet ({age:.0f}s ohne Lebenszeichen)")
+
+        if not dev.ha_ws_state["fallback_active"]:
+            log_event(f"[HA-WS] {dev.name}: Subscription veraltet → REST Fallback")
+            dev.ha_ws_state["fallback_active"] = True
+
+    return float((await fetch_ha(dev)).get("state", "0"))
+
+# ============================================================
+# ✅ GCODE STREAM SCANNER
+# ------------------------------------------------------------
+# Liest die Datei blockweise statt fix 50 KB am Stück und bricht
+# beim ersten Treffer ab. Findet sich im Kopf nichts, wird das
+# Dateiende per Suffix-Range (bytes=-N) gelesen: dort steht bei
+# OrcaSlicer der Config-Block (; chamber_temperature = xx).
+# Treffer über Blockgrenzen hinweg werden über einen kleinen
+# Überlappungs-Puffer gefunden.
+# ============================================================
+GCODE_HEAD_PATTERN = re.compile(rb'(?:M191|M141)\s+S(\d+)|;\s*chamber_temperature\s*=\s*(\d+)')
+# Im Dateiende NUR den Config-Block werten (End-Gcode enthält oft "M141 S0")
+GCODE_TAIL_PATTERN = re.compile(rb';\s*chamber_temperature\s*=\s*(\d+)')
+GCODE_SCAN_OVERLAP = 128
+
+class GcodeScanner:
+    """Inkrementeller Scanner: feed() pro Block, Treffer auch über Blockgrenzen."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.buf = b""
+        self.bytes_read = 0
+
+    def _value(self, m):
+        return safe_float(m.group(1) or m.group(2), 0.0)
+
+    def feed(self, chunk):
+        self.bytes_read += len(chunk)
+        self.buf += chunk
+        m = self.pattern.search(self.buf)
+
+        if m:
+            # Treffer direkt am Pufferende: Zahl evtl. noch unvollständig → nächsten Block abwarten
+            if m.end() < len(self.buf):
+                return self._value(m)
+            self.buf = self.buf[m.start():]
+        else:
+            self.buf = self.buf[-GCODE_SCAN_OVERLAP:]
+        return None
+
+    def finish(self):
+        m = self.pattern.search(self.buf)
+        return self._value(m) if m else None
+
+async def scan_gcode_file(dev, filename):
+    """Liefert dict mit target, where, bytes, ms."""
+    url = f"http://{dev.printer_ip}/server/files/gcodes/{filename}"
+    t0 = time.perf_counter()
+    result = {"target": None, "where": None, "bytes": 0, "ms": 0.0}
+    file_size = None
+
+    # 1️⃣ KOPF
+    async with http_pool.request("GET", url, timeout=5,
+                                 headers={"Range": f"bytes=0-{GCODE_SCAN_HEAD_BYTES - 1}"}) as resp:
+        if resp.status not in (200, 206):
+            raise RuntimeError(f"HTTP {resp.status}")
+        # Content-Range: bytes 0-511999/1234567 → Gesamtgröße
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        file_size = int(total) if total.isdigit() else None
+
+        scanner = GcodeScanner(GCODE_HEAD_PATTERN)
+        target = None
+        async for chunk in resp.content.iter_chunked(GCODE_SCAN_CHUNK):
+            # 200 statt 206 (Range ignoriert) → trotzdem nur GCODE_SCAN_HEAD_BYTES lesen
+            chunk = chunk[:GCODE_SCAN_HEAD_BYTES - scanner.bytes_read]
+            target = scanner.feed(chunk)
+            if target is not None or scanner.bytes_read >= GCODE_SCAN_HEAD_BYTES:
+                break
+        else:
+            target = scanner.finish()
+
+        result["bytes"] += scanner.bytes_read
+        if target is not None:
+            result["target"], result["where"] = target, "head"
+
+    # 2️⃣ ENDE (nur wenn der Kopf nicht schon die ganze Datei war)
+    if (
+        result["target"] is None
+        and GCODE_SCAN_TAIL_BYTES > 0
+        and (file_size is None or file_size > GCODE_SCAN_HEAD_BYTES)
+    ):
+        async with http_pool.request("GET", url, timeout=5,
+                                     headers={"Range": f"bytes=-{GCODE_SCAN_TAIL_BYTES}"}) as resp:
+            # 200 = Server ignoriert Range → nicht die komplette Datei laden
+            if resp.status == 206:
+                scanner = GcodeScanner(GCODE_TAIL_PATTERN)
+                target = None
+                async for chunk in resp.content.iter_chunked(GCODE_SCAN_CHUNK):
+                    target = scanner.feed(chunk)
+                    if target is not None:
+                        break
+                else:
+                    target = scanner.finish()
+
+                result["bytes"] += scanner.bytes_read
+                if target is not None:
+                    result["target"], result["where"] = target, "tail"
+
+    result["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return result
+
+# ============================================================
+# ✅ GCODE CACHE (LRU, AUF DER PLATTE)
+# ------------------------------------------------------------
+# Schlüssel = Dateiname + modified + size aus Moonraker
+# /server/files/metadata → eine neu hochgeladene Datei mit
+# gleichem Namen ist ein neuer Eintrag. Steht chamber_temp schon
+# in den Metadaten (Moonraker liest es aus dem Slicer-Kopf), wird
+# gar nichts heruntergeladen. Ohne Metadaten (alter Moonraker,
+# Fehler) wird wie bisher gescannt, aber nicht gecacht.
+# Speichern: JSON im Worker-Thread, atomar über os.replace.
+# Statistik → <prefix>/gcode_cache + panda_gcode_cache_total.
+# ============================================================
+class GcodeCache:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.entries = OrderedDict()  # key → {"target", "where"}, älteste zuerst
+        self.stats = {"hits": 0, "metadata": 0, "misses": 0, "evictions": 0}
+        self._saving = False  # läuft gerade ein Schreibvorgang?
+        self._dirty = False   # neuer Stand seit Beginn des Schreibvorgangs
+
+    @staticmethod
+    def key(filename, meta):
+        if not meta or "modified" not in meta or "size" not in meta:
+            return None
+        return f"{filename}|{meta['modified']}|{meta['size']}"
+
+    def load(self):
+        if self.size <= 0:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for key, value in json.load(f)[-self.size:]:
+                    self.entries[key] = value
+            log_event(f"[GCODE-CACHE] {len(self.entries)} Einträge geladen")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log_event(f"[GCODE-CACHE-ERR] {self.path}: {e} (starte leer)", force_console=True)
+
+    def _save(self, items):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(items, f)
+        os.replace(tmp, self.path)
+
+    async def save(self):
+        # Immer nur ein Schreiber (gleiche .tmp Datei); Aufrufe währenddessen
+        # werden zu einem weiteren Durchlauf mit dem neuesten Stand zusammengefasst
+        self._dirty = True
+        if self._saving:
+            return
+        self._saving = True
+        try:
+            while self._dirty:
+                self._dirty = False
+                await asyncio.to_thread(self._save, list(self.entries.items()))
+        except OSError as e:
+            log_event(f"[GCODE-CACHE-ERR] {self.path}: {e}")
+        finally:
+            self._saving = False
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def count(self, result):
+        self.stats[result] += 1
+        metrics.gcode_cache.inc(result)
+
+    def snapshot(self):
+        lookups = self.stats["hits"] + self.stats["metadata"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "capacity": self.size,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+            "download_skipped_rate": round((self.stats["hits"] + self.stats["metadata"]) / lookups, 3) if lookups else 0.0
+        }
+
+gcode_cache = GcodeCache(GCODE_CACHE_FILE, GCODE_CACHE_SIZE)
+
+async def fetch_gcode_metadata(dev, filename):
+    """Moonraker Datei-Metadaten oder None (dann ohne Cache)."""
+    try:
+        r = await http_pool.get_json(f"http://{dev.printer_ip}/server/files/metadata?filename={quote(filename)}", timeout=2)
+        return r.get("result")
+    except Exception as e:
+        if DEBUG: log_event(f"[GCODE-CACHE] {dev.name}: keine Metadaten für {filename}: {e}")
+        return None
+
+# Kammer-Temperatur einer Datei → Cache / Metadaten / M191/M141 suchen (auch für Jobs in der Warteschlange)
+async def slicer_target_for(dev, filename):
+    key, meta = None, None
+    if GCODE_CACHE_SIZE > 0:
+        meta = await fetch_gcode_metadata(dev, filename)
+        key = gcode_cache.key(filename, meta)
+    cached = gcode_cache.get(key) if key else None
+    meta_temp = safe_float(meta.get("chamber_temp")) if meta else 0.0
+
+    if cached is not None:
+        gcode_cache.count("hits")
+        scan = {**cached, "bytes": 0, "ms": 0.0, "cache": "hit"}
+    elif meta_temp > 0:
+        # Moonraker hat den Wert schon aus dem Slicer-Kopf gelesen → kein Download
+        gcode_cache.count("metadata")
+        scan = {"target": meta_temp, "where": "metadata", "bytes": 0, "ms": 0.0, "cache": "metadata"}
+    else:
+        if key:
+            gcode_cache.count("misses")
+        scan = await scan_gcode_file(dev, filename)
+        scan["cache"] = "miss" if key else "off"
+
+    if key and cached is None:
+        gcode_cache.put(key, {"target": scan["target"], "where": scan["where"]})
+        spawn(gcode_cache.save())
+    if key:
+        mqtt_client.publish(f"{dev.prefix}/gcode_cache", json.dumps(gcode_cache.snapshot()))
+    return scan
+
+# ✅ SLICER ANALYSE (eine Datei → M191/M141 suchen)
+async def analyze_slicer_file(dev, filename):
+    log_event(f"[SLICER] {dev.name}: Neue Datei erkannt: {filename}")
+
+    scan = await slicer_target_for(dev, filename)
+    log_event(
+        f"[SLICER] {dev.name}: Scan {filename}: {scan['bytes']} Bytes in {scan['ms']} ms "
+        f"→ {scan['target'] if scan['target'] is not None else 'kein Treffer'} ({scan['where'] or '-'}, Cache: {scan['cache']})"
+    )
+    mqtt_client.publish(f"{dev.prefix}/slicer_scan", json.dumps({"file": filename, **scan}))
+    apply_slicer_target(dev, filename, scan["target"])
+
+# Ergebnis der Gcode Analyse übernehmen (auch für den Trace-Replay)
+def apply_slicer_target(dev, filename, new_target):
+    trace("slicer", dev, [filename, new_target])
+
+    if new_target is not None:
+        dev.state.slicer_soll = new_target
+        dev.state.last_analyzed_file = filename
+
+        state_pub.publish(f"{dev.prefix}/slicer_soll", int(new_target), retain=True)
+        state_pub.publish(f"{dev.prefix}/slicer_target_temp", int(new_target), retain=True)
+        state_pub.publish(f"{dev.prefix}/slicer_file", filename, retain=True)
+
+        if dev.state.slicer_priority_mode and new_target > 15:
+            dev.state.kammer_soll = new_target
+            mark_input_changed(dev)
+            dev.cmd_queue.submit({"settings": {"set_temp": int(new_target)}})
+            state_pub.publish(f"{dev.prefix}/soll", int(new_target), retain=True)
+    else:
+        dev.state.last_analyzed_file = filename
+        state_pub.publish(f"{dev.prefix}/slicer_file", filename, retain=True)
+
+# ✅ SLICER PARSER (OPTIMIERT: async über den HTTP Pool, blockiert den Heartbeat nicht)
+async def slicer_auto_parser(dev):
+    while True:
+        try:
+            r = await http_pool.get_json(f"http://{dev.printer_ip}/printer/objects/query?print_stats", timeout=2)
+            startup.mark(f"printer:{dev.name}")
             filename = r.get("result", {}).get("status", {}).get("print_stats", {}).get("filename", "")
 
-            if filename and filename != current_data["last_analyzed_file"]:
-                log_event(f"[SLICER] Neue Datei erkannt: {filename}")
-                
-                def fetch_gcode():
-                    return requests.get(f"http://{PRINTER_IP}/server/files/gcodes/{filename}", 
-                                        headers={'Range': 'bytes=0-50000'}, timeout=5)
-                
-                resp = await loop.run_in_executor(None, fetch_gcode)
-
-                if resp.status_code in [200, 206]:
-                    import re
-                    match = re.search(r'(?:M191|M141)\s+S(\d+)', resp.text)
-                    if match:
-                        new_target = safe_float(match.group(1), 0.0)
-                        current_data["slicer_soll"] = new_target
-                        current_data["last_analyzed_file"] = filename
-
-                        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/slicer_soll", int(new_target), retain=True)
-                        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/slicer_target_temp", int(new_target), retain=True)
-                        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/slicer_file", filename, retain=True)
-
-                        if current_data["slicer_priority_mode"] and new_target > 15:
-                            current_data["kammer_soll"] = new_target
-                            if panda_ws:
-                                asyncio.run_coroutine_threadsafe(
-                                    panda_ws.send(json.dumps({"settings": {"set_temp": int(new_target)}})),
-                                    main_loop
-                                )
-                            mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/soll", int(new_target), retain=True)
-                    else:
-                        current_data["last_analyzed_file"] = filename
-                        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/slicer_file", filename, retain=True)
+            if filename and filename != dev.state.last_analyzed_file:
+                await analyze_slicer_file(dev, filename)
 
         except Exception as e:
             if DEBUG: log_event(f"DEBUG:SLICER-ERR:{e}")
         await asyncio.sleep(5)
 
+# ============================================================
+# ✅ VORHEIZEN AUS DER MOONRAKER WARTESCHLANGE (job_queue)
+# ------------------------------------------------------------
+# Liest /server/job_queue/status, analysiert den ersten Job vorab
+# (Gcode Cache → beim echten Start ist er schon bekannt) und
+# schätzt seinen Start: Drucker frei + Warteschlange "ready" →
+# sofort, läuft ein Druck → estimated_time (Metadaten) minus
+# print_duration. Ist der Start ≤ PREHEAT_LEAD Sek. entfernt,
+# setzt er dev.state.preheat_target: control_step heizt dann auf
+# max(Soll, Vorheiz-Ziel), schon während der laufende Druck noch
+# läuft und danach auch bei kaltem Bett. Liegt das Panda Soll
+# darunter, geht set_temp an den Panda. Ende: Job läuft, Job weg,
+# Warteschlange pausiert, PREHEAT_MAX_TIME überschritten, Lock
+# oder Panda aus → außer beim Job-Start kommt das vorherige
+# Panda Soll zurück. Status → <prefix>/preheat (retained).
+# ============================================================
+def set_preheat(dev, filename, target, reason, eta=None, soll=None):
+    dev.state.preheat_file, dev.state.preheat_target = filename, target
+    if soll is not None:
+        # Panda Soll (Vorheiz-Ziel bzw. Wert von vorher) → im Trace, damit das Replay gleich rechnet
+        dev.state.kammer_soll = soll
+        dev.cmd_queue.submit({"settings": {"set_temp": int(soll)}})
+        state_pub.publish(f"{dev.prefix}/soll", int(soll), retain=True)
+    trace("preheat", dev, [filename, target, soll])
+    mark_input_changed(dev)
+    log_event(f"[PREHEAT] {dev.name}: {reason} ({filename or '-'}, {target}°)", force_console=True)
+    state_pub.publish(f"{dev.prefix}/preheat", json.dumps({
+        "active": target > 0, "file": filename, "target": target,
+        "eta_s": round(eta) if eta is not None else None, "reason": reason
+    }), retain=True)
+
+async def job_start_eta(dev, print_stats):
+    """Sek. bis der aktuelle Druck fertig ist, None = unbekannt."""
+    meta = await fetch_gcode_metadata(dev, print_stats.get("filename", ""))
+    estimated = safe_float(meta.get("estimated_time")) if meta else 0.0
+    if estimated <= 0:
+        return None
+    return max(0.0, estimated - safe_float(print_stats.get("print_duration")))
+
+async def job_queue_preheat(dev):
+    targets = {}        # Dateiname → Slicer-Temperatur (None = kein Wert)
+    expired = set()     # Jobs, deren Vorheizen per Zeitlimit beendet wurde
+    started_at = 0.0
+    restore = None      # Panda Soll vor dem Vorheizen (None = noch nicht an den Panda gesendet)
+
+    def stop(reason):
+        nonlocal restore
+        # Job gestartet → dessen Slicer-Soll übernimmt, sonst altes Soll zurück
+        set_preheat(dev, "", 0.0, reason, soll=None if reason == "Job gestartet" else restore)
+        restore = None
+
+    while True:
+        try:
+            # Aus (auch per Config-Reload), Lock oder Panda aus → kein Vorheizen
+            blocked = "Gesperrt" if dev.state.global_lock or dev.state.power_forced_off else None
+            if PREHEAT_LEAD <= 0 or blocked:
+                if dev.state.preheat_target > 0:
+                    stop(blocked or "Deaktiviert")
+                await asyncio.sleep(max(PREHEAT_POLL_INTERVAL, 5))  # 0 würde Moonraker ohne Pause abfragen
+                continue
+
+            base = f"http://{dev.printer_ip}"
+            q = (await http_pool.get_json(f"{base}/server/job_queue/status", timeout=2)).get("result", {})
+            r = await http_pool.get_json(f"{base}/printer/objects/query?print_stats", timeout=2)
+            ps = r.get("result", {}).get("status", {}).get("print_stats", {})
+            printing = ps.get("state") in ("printing", "paused")
+
+            jobs = [j.get("filename", "") for j in q.get("queued_jobs") or []]
+            for fn in list(targets):
+                if fn not in jobs:
+                    del targets[fn]
+            expired &= set(jobs)
+
+            # Nächster Job + geschätzter Start (pausierte Warteschlange startet nicht von selbst)
+            want, eta = None, None
+            if jobs and q.get("queue_state") != "paused" and jobs[0] not in expired:
+                fn = jobs[0]
+                if fn not in targets:
+                    targets[fn] = (await slicer_target_for(dev, fn))["target"]
+                eta = await job_start_eta(dev, ps) if printing else 0.0
+                if targets[fn] and eta is not None and eta <= PREHEAT_LEAD:
+                    want = fn
+
+            active = dev.state.preheat_target > 0
+            if active and want != dev.state.preheat_file:
+                started = printing and ps.get("filename") == dev.state.preheat_file
+                stop("Job gestartet" if started else "Job nicht mehr in der Warteschlange")
+                active = False
+
+            if active and time.time() - started_at > PREHEAT_MAX_TIME:
+                expired.add(dev.state.preheat_file)
+                stop("Zeitlimit erreicht")
+                active, want = False, None
+
+            if want and not active:
+                started_at = time.time()
+                set_preheat(dev, want, float(targets[want]), "Start", eta)
+
+            # Panda Soll anheben, auch während der laufende Druck noch läuft (Panda heizt nur bis set_temp)
+            if dev.state.preheat_target > float(dev.state.kammer_soll):
+                if restore is None:
+                    restore = dev.state.kammer_soll
+                set_preheat(dev, dev.state.preheat_file, dev.state.preheat_target, "Panda Soll gesetzt", eta,
+                            soll=dev.state.preheat_target)
+
+        except Exception as e:
+            if DEBUG: log_event(f"[PREHEAT-ERR] {dev.name}: {e}")
+        await asyncio.sleep(max(PREHEAT_POLL_INTERVAL, 5))  # 0 würde Moonraker ohne Pause abfragen
+
+# ============================================================
+# ✅ MOONRAKER WEBSOCKET (JSON-RPC statt HTTP Polling)
+# ------------------------------------------------------------
+# Eine Verbindung, printer.objects.subscribe auf print_stats
+# (filename/state) und heater_bed. notify_status_update kommt
+# sofort bei Änderung → neue Datei wird ohne 5s Verzögerung
+# analysiert. heater_bed liefert die Bett-Temperatur direkt
+# (BED_SENSOR_SOURCE = "moonraker", ohne HA).
+# Zustand liegt pro Gerät in dev.moonraker_state.
+# ============================================================
+MOONRAKER_SUBSCRIBE_OBJECTS = {
+    "print_stats": ["filename", "state"],
+    "heater_bed": ["temperature"]
+}
+
+def moonraker_apply_status(dev, status):
+    ps = status.get("print_stats", {})
+    if "filename" in ps:
+        dev.moonraker_state["filename"] = ps["filename"] or ""
+    if "state" in ps:
+        dev.moonraker_state["print_state"] = ps["state"] or ""
+    if "temperature" in status.get("heater_bed", {}):
+        dev.moonraker_state["bed"] = status["heater_bed"]["temperature"]
+        dev.bed_pushed.set()
+
+    filename = dev.moonraker_state["filename"]
+    if (
+        filename
+        and filename != dev.state.last_analyzed_file
+        and (dev.slicer_analysis_task is None or dev.slicer_analysis_task.done())
+    ):
+        async def run():
+            try:
+                await analyze_slicer_file(dev, filename)
+            except Exception as e:
+                if DEBUG: log_event(f"DEBUG:SLICER-ERR:{e}")
+
+        dev.slicer_analysis_task = asyncio.create_task(run())
+
+async def moonraker_ws_client(dev):
+    uri = f"ws://{dev.printer_ip}/websocket"
+    req_id = 0
+
+    while True:
+        try:
+            async with websockets.connect(uri, ping_interval=20, max_size=None) as ws:
+                log_event(f"[MOONRAKER-WS] {dev.name}: Verbunden mit {dev.printer_ip}")
+                startup.mark(f"printer:{dev.name}")
+
+                async def subscribe():
+                    nonlocal req_id
+                    req_id += 1
+                    await ws.send(json.dumps({
+                        "jsonrpc": "2.0",
+                        "method": "printer.objects.subscribe",
+                        "params": {"objects": MOONRAKER_SUBSCRIBE_OBJECTS},
+                        "id": req_id
+                    }))
+                    return req_id
+
+                sub_id = await subscribe()
+
+                async for raw in ws:
+                    msg = json.loads(raw)
+                    dev.moonraker_state["last_seen"] = time.time()
+                    method = msg.get("method")
+
+                    # Antwort auf subscribe → enthält den kompletten Startzustand
+                    if msg.get("id") == sub_id:
+                        if "error" in msg:
+                            # Klippy noch nicht bereit → notify_klippy_ready abwarten
+                            log_event(f"[MOONRAKER-WS] Subscribe fehlgeschlagen: {msg['error'].get('message')}")
+                            continue
+                        dev.moonraker_state["connected"] = True
+                        moonraker_apply_status(dev, msg.get("result", {}).get("status", {}))
+
+                    elif method == "notify_status_update":
+                        moonraker_apply_status(dev, msg["params"][0])
+
+                    elif method == "notify_klippy_ready":
+                        sub_id = await subscribe()
+
+                    elif method in ("notify_klippy_shutdown", "notify_klippy_disconnected"):
+                        # Ohne Klippy keine gültigen Werte → Bett-Sensor gilt als Fehler
+                        dev.moonraker_state["connected"] = False
+                        dev.moonraker_state["bed"] = None
+
+        except Exception as e:
+            log_event(f"[MOONRAKER-WS-ERR] {e}")
+
+        dev.moonraker_state["connected"] = False
+        dev.moonraker_state["bed"] = None
+        await asyncio.sleep(5)
+
+# ============================================================
+# ✅ COMMAND INBOX (paho Thread → Event Loop)
+# ------------------------------------------------------------
+# on_mqtt_message läuft im paho Netzwerk-Thread und darf den
+# DeviceState NICHT anfassen. Befehle landen in einer
+# thread-sicheren Queue, der Loop wird per call_soon_threadsafe
+# geweckt und handle_device_command läuft im Event Loop.
+# Befehle, die vor dem Start des Loops ankommen, bleiben in der
+# Queue und werden beim Start abgearbeitet.
+# ============================================================
+class CommandInbox:
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._wakeup = None
+        self._loop = None
+
+    def put(self, dev, msg, t_recv):
+        # Aufruf aus beliebigem Thread
+        self._queue.put((dev, msg, t_recv))
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()  # evtl. schon vorhandene Befehle sofort abarbeiten
+        self._loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                try:
+                    dev, msg, t_recv = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                await dispatch_command(dev, msg, t_recv)
+
+command_inbox = CommandInbox()
+
+# ============================================================
+# ✅ BEFEHLS-LATENZ (MQTT Empfang → erstes Panda WS send)
+# ------------------------------------------------------------
+# dispatch_command merkt sich den Empfangszeitpunkt in einer
+# ContextVar, PandaCommandQueue.submit hängt ihn an den ersten
+# Frame. panda_send misst beim Senden die Latenz und
+# veröffentlicht sie auf <prefix>/cmd_latency (inkl. MQTT_LOOP_MODE).
+# ============================================================
+cmd_received_at = contextvars.ContextVar("cmd_received_at", default=None)
+
+cmd_latency = LatencyStats()
+
+async def dispatch_command(dev, msg, t_recv):
+    trace("mqtt_in", dev, [msg.topic, msg.payload.decode(errors="replace")])
+    before = dev.state.snapshot()
+    token = cmd_received_at.set(t_recv)
+    try:
+        handle_device_command(dev, msg)
+    except Exception as e:
+        log_event(f"[CMD-ERR] {msg.topic}: {e}", force_console=True)
+    finally:
+        cmd_received_at.reset(token)
+    changes = dev.state.diff(before)
+    if changes:
+        mark_input_changed(dev)  # Soll/Modus/Lock geändert → Regelung sofort neu rechnen
+        if DEBUG: log_event(f"[STATE] {dev.name}: {msg.topic} → {changes}")
+
+async def panda_send(dev, payload, t_recv=None):
+    await dev.panda_ws.send(json.dumps(payload))
+    trace("ws_out", dev, payload)
+
+    if t_recv is not None:
+        ms = (time.perf_counter() - t_recv) * 1000
+        cmd_latency.record(ms)
+        if DEBUG: log_event(f"[LATENZ] {dev.name}: MQTT → WS send {ms:.2f} ms ({MQTT_LOOP_MODE})")
+        mqtt_client.publish(
+            f"{dev.prefix}/cmd_latency",
+            json.dumps({"mode": MQTT_LOOP_MODE, **cmd_latency.summary()})
+        )
+
+# Task im Event Loop starten (Referenz halten, sonst kann der GC ihn einsammeln)
+_spawned_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    _spawned_tasks.add(task)
+    task.add_done_callback(_spawned_tasks.discard)
+    return task
+
+# ============================================================
+# ✅ PANDA BEFEHLS-QUEUE (ein Schreiber pro Gerät)
+# ------------------------------------------------------------
+# Handler schicken nicht mehr selbst an panda_ws, sondern
+# submit() in die Queue. Ein Task pro Gerät sendet Frame für
+# Frame und wartet auf das Echo (settings mit den gesendeten
+# Werten) statt fester asyncio.sleep Pausen.
+# - submit(a, b, c): Reihenfolge bleibt, jeder Frame einzeln
+# - submit(a) allein: wird mit dem letzten wartenden Einzel-
+#   Frame zusammengefasst (HA Slider → nur der letzte Wert)
+# - urgent=True: wartende Frames verwerfen (Not-Aus)
+# Tiefe, RTT und Zähler gehen auf <prefix>/ws_queue.
+# ============================================================
+def _ws_value(v):
+    # Panda antwortet mal mit bool, mal mit 0/1 oder "1"
+    if isinstance(v, bool):
+        return int(v)
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return v
+
+# Diese settings meldet der Panda nicht zurück → kein Echo abwarten, nur PANDA_CMD_GAP Pause
+PANDA_NO_ECHO_KEYS = {"isrunning"}
+
+class PandaCommandQueue:
+    def __init__(self, dev):
+        self.dev = dev
+        self.pending = deque()  # {"payload", "mergeable", "t_recv"}
+        self._wakeup = asyncio.Event()
+        self._ack = None  # (gesendete settings, Future) während auf das Echo gewartet wird
+        self.rtt = LatencyStats()
+        self.stats = {"sent": 0, "merged": 0, "acked": 0, "paced": 0, "timeouts": 0, "dropped": 0, "blocked": 0, "max_depth": 0}
+
+    def submit(self, *payloads, urgent=False, lock=False):
+        if self.dev.panda_ws is None:
+            return False
+        # Im Lock (Not-Aus) gehen nur Aus-Befehle raus (heizung_stop / enforce_lock),
+        # sonst überschreiben Slicer / Vorheizen den gesperrten Panda
+        if self.dev.state.global_lock and not lock:
+            self.stats["blocked"] += len(payloads)
+            return False
+
+        if urgent:
+            self.stats["dropped"] += len(self.pending)
+            self.pending.clear()
+
+        t_recv = cmd_received_at.get()
+        tail = self.pending[-1] if self.pending else None
+        single = len(payloads) == 1 and not urgent and set(payloads[0]) == {"settings"}
+
+        if single and tail is not None and tail["mergeable"]:
+            tail["payload"]["settings"].update(payloads[0]["settings"])
+            if tail["t_recv"] is None:
+                tail["t_recv"] = t_recv
+            self.stats["merged"] += 1
+        else:
+            for p in payloads:
+                payload = dict(p, settings=dict(p["settings"]))
+                self.pending.append({"payload": payload, "mergeable": single, "t_recv": t_recv})
+                t_recv = None  # Latenz nur für den ersten Frame
+
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self.pending))
+        self._wakeup.set()
+        return True
+
+    def on_settings(self, incoming):
+        # Aufruf aus update_limits_from_ws für jedes settings Paket
+        if self._ack is None:
+            return
+        expected, fut = self._ack
+        present = [k for k in expected if k in incoming]
+        if present and not fut.done() and all(
+            _ws_value(expected[k]) == _ws_value(incoming[k]) for k in present
+        ):
+            fut.set_result(True)
+
+    def snapshot(self):
+        return {"depth": len(self.pending), **self.stats, "rtt": self.rtt.summary()}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+
+            while self.pending:
+                if self.dev.panda_ws is None:
+                    # Verbindung weg → alte Befehle nicht später nachschicken
+                    self.stats["dropped"] += len(self.pending)
+                    self.pending.clear()
+                    break
+
+                step = self.pending.popleft()
+                fut = loop.create_future()
+                expected = {k: v for k, v in step["payload"]["settings"].items() if k not in PANDA_NO_ECHO_KEYS}
+                self._ack = (expected, fut)
+                t0 = time.perf_counter()
+                try:
+                    await panda_send(self.dev, step["payload"], step["t_recv"])
+                    self.stats["sent"] += 1
+                    if not expected:
+                        # Kein Echo zu erwarten → nur kurz Abstand halten (wie früher die festen sleeps)
+                        await asyncio.sleep(PANDA_CMD_GAP)
+                        self.stats["paced"] += 1
+                        continue
+                    await asyncio.wait_for(fut, PANDA_ACK_TIMEOUT)
+                    self.rtt.record((time.perf_counter() - t0) * 1000)
+                    self.stats["acked"] += 1
+                except asyncio.TimeoutError:
+                    self.stats["timeouts"] += 1
+                    if DEBUG: log_event(f"[WS-QUEUE] {self.dev.name}: kein Echo für {step['payload']}")
+                except Exception as e:
+                    log_event(f"[WS-QUEUE-ERR] {self.dev.name}: {e}")
+                finally:
+                    self._ack = None
+
+            self._wakeup.clear()
+            mqtt_client.publish(f"{self.dev.prefix}/ws_queue", json.dumps(self.snapshot()))
+
 # --- MQTT LOGIK ---
 def on_mqtt_message(client, userdata, msg):
-    # ✅ FIX: Alle globalen Deklarationen MÜSSEN am Anfang der Funktion stehen 
-    global current_data
-    global last_ha_change
-    global ha_memory
-    global heating_locked
-    global power_forced_off
-    global global_lock
-    global desired_power_state
-    global power_pending_until
-    global global_heating_state
+    # HA Birth → Discovery (nur geänderte Configs)
+    if msg.topic == HA_STATUS_TOPIC:
+        ha_discovery.on_ha_status(msg.payload)
+        return
+
+    # Routing über den Präfix → Gerät, Ausführung im Event Loop
+    dev = device_for_topic(msg.topic)
+    if dev is None:
+        return
+    metrics.mqtt_messages.inc(dev.name)
+    t_recv = time.perf_counter()
+    if MQTT_LOOP_MODE == "asyncio":
+        # wir sind schon im Event Loop (loop_read aus add_reader)
+        spawn(dispatch_command(dev, msg, t_recv))
+    else:
+        command_inbox.put(dev, msg, t_recv)
+
+# Läuft im Event Loop (dispatch_command), nie im paho Thread
+def handle_device_command(dev, msg):
     # ============================================================
     # ✅ UNLOCK LOGIK (Muss VOR dem Lock-Check kommen!)
     # ------------------------------------------------------------
-    if msg.topic == f"{MQTT_TOPIC_PREFIX}/unlock/set":
+    if msg.topic == f"{dev.prefix}/unlock/set":
         log_event(">>> SYSTEM UNLOCKED <<<", force_console=True)
-        global_lock = False
-        heating_locked = False
-        power_forced_off = False
+        dev.state.global_lock = False
+        dev.state.heating_locked = False
+        dev.state.power_forced_off = False
 
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/lock_status", "UNLOCKED", retain=True)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/status", "Bereit", retain=True)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/panda_modus", "Standby", retain=True)
+        state_pub.publish(f"{dev.prefix}/lock_status", "UNLOCKED", retain=True)
+        state_pub.publish(f"{dev.prefix}/status", "Bereit", retain=True)
+        state_pub.publish(f"{dev.prefix}/panda_modus", "Standby", retain=True)
         return
 
 # 🛑 GLOBAL LOCK CHECK: Wenn gesperrt (Emergency Stop), wird alles andere ignoriert
-    if global_lock:
+    if dev.state.global_lock:
         # Erlaube NUR das Unlock-Topic, alles andere wird blockiert
-        if msg.topic.endswith("/set") and msg.topic != f"{MQTT_TOPIC_PREFIX}/unlock/set":
+        if msg.topic.endswith("/set") and msg.topic != f"{dev.prefix}/unlock/set":
             log_event(f"[BLOCKED] System ist LOCKED! Befehl ignoriert: {msg.topic}", force_console=True)
             return
 
+    # ============================================================
+    # ✅ VERLAUF ABFRAGEN (Antwort auf {prefix}/history)
+    # Payload: {"seconds": 3600, "buckets": 60} oder nur Sekunden
+    # ============================================================
+    if msg.topic == f"{dev.prefix}/history/get":
+        try:
+            req = json.loads(msg.payload.decode() or "{}")
+            if not isinstance(req, dict):
+                req = {"seconds": req}
+            seconds = float(req.get("seconds", 3600))
+            buckets = max(1, min(int(req.get("buckets", 60)), HISTORY_MAX_BUCKETS))
+        except (ValueError, TypeError) as e:
+            log_event(f"[HISTORY-ERR] {e}", force_console=True)
+            return
+        end = time.time()
+        mqtt_client.publish(f"{dev.prefix}/history", json.dumps(dev.history.query(end - seconds, end, buckets)))
+        return
+
+    # ============================================================
+    # ✅ PROFILER STARTEN (Payload = Sekunden, Ergebnis auf {prefix}/profile)
+    # ============================================================
+    if msg.topic == f"{dev.prefix}/profile/start":
+        loop_watchdog.start_profile(dev, safe_float(msg.payload.decode(), 10.0))
+        return
+
     # ✅ FEHLENDE ENTITÄT 1: switch.panda_breath_mod_slicer_priority_mode
     # ============================================================
     # ✅ SLICER PRIORITY MODE
     # ============================================================
-    if msg.topic == f"{MQTT_TOPIC_PREFIX}/slicer_priority_mode/set":
+    if msg.topic == f"{dev.prefix}/slicer_priority_mode/set":
 
         payload = msg.payload.decode().strip().lower()
         is_on = payload in ("on", "1", "true")
-        current_data["slicer_priority_mode"] = is_on
+        dev.state.slicer_priority_mode = is_on
 
         log_event(">>> SLICER MODE ENTERED <<<", force_console=True)
 
-        mqtt_client.publish(
-            f"{MQTT_TOPIC_PREFIX}/slicer_priority_mode",
+        state_pub.publish(
+            f"{dev.prefix}/slicer_priority_mode",
             "ON" if is_on else "OFF",
             retain=True
         )
 
         if is_on:
-            slicer_val = float(current_data.get("slicer_soll", 0))
+            slicer_val = float(dev.state.slicer_soll)
 
             if slicer_val > 15:
-                current_data["kammer_soll"] = slicer_val
-
-            if panda_ws:
-                asyncio.run_coroutine_threadsafe(
-                    panda_ws.send(json.dumps({
-                        "settings": {
-                            "set_temp": int(slicer_val),
-                            "work_on": 1,
-                            "isrunning": 1
-                        }
-                    })),
-                    main_loop
-                )
+                dev.state.kammer_soll = slicer_val
+
+            if dev.panda_ws:
+                dev.cmd_queue.submit({
+                    "settings": {
+                        "set_temp": int(slicer_val),
+                        "work_on": 1,
+                        "isrunning": 1
+                    }
+                })
 
-                mqtt_client.publish(
-                    f"{MQTT_TOPIC_PREFIX}/soll",
+                state_pub.publish(
+                    f"{dev.prefix}/soll",
                     int(slicer_val),
                     retain=True
                 )
@@ -295,148 +1905,113 @@ def on_mqtt_message(client, userdata, msg):
     # ============================================================
     # ✅ HEIZUNG STOP (NOT-AUS MIT LOCK) - VERBESSERT
     # ------------------------------------------------------------
-    if msg.topic == f"{MQTT_TOPIC_PREFIX}/heizung_stop/set":
+    if msg.topic == f"{dev.prefix}/heizung_stop/set":
         log_event(">>> !!! EMERGENCY STOP & LOCK !!! <<<", force_console=True)
         
-        global_lock = True    
-        heating_locked = True 
-        global_heating_state = 20.0  # 🔥 FIX: Heizung SOFORT logisch ausschalten
-
-        async def stop_flow():
-            if panda_ws:
-                # Wir schalten ALLES am Panda sofort aus
-                await panda_ws.send(json.dumps({"settings": {"isrunning": 0, "work_mode": 0, "work_on": 0}}))
-        
-        asyncio.run_coroutine_threadsafe(stop_flow(), main_loop)
+        dev.state.global_lock = True    
+        dev.state.heating_locked = True 
+        dev.state.global_heating_state = 20.0  # 🔥 FIX: Heizung SOFORT logisch ausschalten
+
+        # Wir schalten ALLES am Panda sofort aus (wartende Befehle verwerfen)
+        dev.cmd_queue.submit({"settings": {"isrunning": 0, "work_mode": 0, "work_on": 0}}, urgent=True, lock=True)
 
         # Status an HA melden
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/lock_status", "LOCKED", retain=True)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/panda_modus", "LOCKED", retain=True)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/status", "Emergency Lock", retain=True)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/work_on", "0", retain=True) 
+        state_pub.publish(f"{dev.prefix}/lock_status", "LOCKED", retain=True)
+        state_pub.publish(f"{dev.prefix}/panda_modus", "LOCKED", retain=True)
+        state_pub.publish(f"{dev.prefix}/status", "Emergency Lock", retain=True)
+        state_pub.publish(f"{dev.prefix}/work_on", "0", retain=True) 
         return
 
     # --- MANUELL MODUS ---
     if msg.topic.endswith("/manual/set"):
         log_event(">>> MANUELL MODE ENTERED <<<", force_console=True)
-        heating_locked = False
-        power_forced_off = False
-        current_data["kammer_soll"] = 45.0
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/panda_modus", "Manuell", retain=True)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/slicer_priority_mode", "OFF", retain=True)
-        async def flow():
-            if panda_ws:
-                await panda_ws.send(json.dumps({"settings": {"isrunning": 0}}))
-                await asyncio.sleep(0.2)
-                await panda_ws.send(json.dumps({"settings": {"work_mode": 2}}))
-        asyncio.run_coroutine_threadsafe(flow(), main_loop)
+        dev.state.heating_locked = False
+        dev.state.power_forced_off = False
+        dev.state.kammer_soll = 45.0
+        state_pub.publish(f"{dev.prefix}/panda_modus", "Manuell", retain=True)
+        state_pub.publish(f"{dev.prefix}/slicer_priority_mode", "OFF", retain=True)
+        dev.cmd_queue.submit(
+            {"settings": {"isrunning": 0}},
+            {"settings": {"work_mode": 2}}
+        )
         return
 
     # --- AUTO MODUS ---
-    if msg.topic == f"{MQTT_TOPIC_PREFIX}/auto/set":
+    if msg.topic == f"{dev.prefix}/auto/set":
         log_event(">>> AUTO MODE ENTERED <<<", force_console=True)
-        heating_locked = False
-        power_forced_off = False
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/panda_modus", "Automatik", retain=True)
-        current_data["slicer_priority_mode"] = False
-        async def flow():
-            if panda_ws:
-                await panda_ws.send(json.dumps({"settings": {"isrunning": 0}}))
-                await asyncio.sleep(0.1)
-                await panda_ws.send(json.dumps({"settings": {"work_mode": 1}, "ui_action": "auto"}))
-                await asyncio.sleep(0.1)
-                await panda_ws.send(json.dumps({"settings": {"isrunning": 1}}))
-        asyncio.run_coroutine_threadsafe(flow(), main_loop)
+        dev.state.heating_locked = False
+        dev.state.power_forced_off = False
+        state_pub.publish(f"{dev.prefix}/panda_modus", "Automatik", retain=True)
+        dev.state.slicer_priority_mode = False
+        dev.cmd_queue.submit(
+            {"settings": {"isrunning": 0}},
+            {"settings": {"work_mode": 1}, "ui_action": "auto"},
+            {"settings": {"isrunning": 1}}
+        )
         return
         
     # --- DRY MODUS ---
     if msg.topic.endswith("/drying/set"):
         log_event(">>> DRYER MODE ENTERED <<<", force_console=True)
 
-        heating_locked = False
-        power_forced_off = False
+        dev.state.heating_locked = False
+        dev.state.power_forced_off = False
 
-        mqtt_client.publish(
-            f"{MQTT_TOPIC_PREFIX}/panda_modus",
+        state_pub.publish(
+            f"{dev.prefix}/panda_modus",
             "Dry",
             retain=True
         )
 
-        async def flow():
-            if panda_ws:
-                await panda_ws.send(json.dumps({
-                    "settings": {
-                        "work_mode": 3
-                    }
-                }))
-                await asyncio.sleep(0.2)
-
-                await panda_ws.send(json.dumps({
-                    "settings": {
-                        "isrunning": 1
-                    }
-                }))
-
-        asyncio.run_coroutine_threadsafe(flow(), main_loop)
+        dev.cmd_queue.submit(
+            {"settings": {"work_mode": 3}},
+            {"settings": {"isrunning": 1}}
+        )
         return
         
     # --- START / STOP ---
-    if msg.topic == f"{MQTT_TOPIC_PREFIX}/work_on/set":
+    if msg.topic == f"{dev.prefix}/work_on/set":
         payload = msg.payload.decode().strip().lower()
         is_on = payload in ("on", "1", "true")
-        async def p_flow():
-            if panda_ws:
-                if not is_on:
-                    await panda_ws.send(json.dumps({"settings": {"isrunning": 0, "work_mode": 0}}))
-                else:
-                    await panda_ws.send(json.dumps({"settings": {"work_on": 1, "isrunning": 1}}))
-        asyncio.run_coroutine_threadsafe(p_flow(), main_loop)
-        mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/work_on", "1" if is_on else "0", retain=True)
+        if not is_on:
+            dev.cmd_queue.submit({"settings": {"isrunning": 0, "work_mode": 0}})
+        else:
+            dev.cmd_queue.submit({"settings": {"work_on": 1, "isrunning": 1}})
+        state_pub.publish(f"{dev.prefix}/work_on", "1" if is_on else "0", retain=True)
         return
         
     # PANDA POWER SWITCH
-    if msg.topic == f"{MQTT_TOPIC_PREFIX}/panda_power/set":
+    if msg.topic == f"{dev.prefix}/panda_power/set":
  
 
         payload = msg.payload.decode().strip().upper()
         is_on = payload == "ON"
 
         # Optimistic / Pending setzen (damit WS-Status nicht sofort zurückflippt)
-        desired_power_state = is_on
-        power_pending_until = time.time() + POWER_CONFIRM_TIMEOUT
+        dev.state.desired_power_state = is_on
+        dev.state.power_pending_until = time.time() + POWER_CONFIRM_TIMEOUT
 
-        mqtt_client.publish(
-            f"{MQTT_TOPIC_PREFIX}/panda_power",
+        state_pub.publish(
+            f"{dev.prefix}/panda_power",
             "ON" if is_on else "OFF",
             retain=True
         )
 
         if not is_on:
             log_event(">>> PANDA POWER OFF <<<", force_console=True)
-            heating_locked = True
-            power_forced_off = True
-
-            async def hard_power_off():
-                try:
-                    if panda_ws:
-                        # Reihenfolge wie von dir bewiesen:
-                        await panda_ws.send(json.dumps({"settings": {"isrunning": 0}}))
-                        await asyncio.sleep(0.2)
-
-                        await panda_ws.send(json.dumps({"settings": {"work_mode": 0}}))
-                        await asyncio.sleep(0.2)
-
-                        # WICHTIG: bool false (nicht 0)
-                        await panda_ws.send(json.dumps({"settings": {"work_on": False}}))
-                        await asyncio.sleep(0.2)
-
-                except Exception as e:
-                    log_event(f"[POWER-OFF-ERR] {e}")
-
-            asyncio.run_coroutine_threadsafe(hard_power_off(), main_loop)
+            dev.state.heating_locked = True
+            dev.state.power_forced_off = True
+
+            # Reihenfolge wie von dir bewiesen (je ein Frame, Echo abwarten):
+            dev.cmd_queue.submit(
+                {"settings": {"isrunning": 0}},
+                {"settings": {"work_mode": 0}},
+                # WICHTIG: bool false (nicht 0)
+                {"settings": {"work_on": False}}
+            )
 
-            mqtt_client.publish(
-                f"{MQTT_TOPIC_PREFIX}/panda_modus",
+            state_pub.publish(
+                f"{dev.prefix}/panda_modus",
                 "Standby",
                 retain=True
             )
@@ -445,19 +2020,11 @@ def on_mqtt_message(client, userdata, msg):
 
         else:
             log_event(">>> PANDA POWER ON <<<", force_console=True)
-            heating_locked = False
-            power_forced_off = False
-
-            async def power_on():
-                try:
-                    if panda_ws:
-                        # ON als bool True
-                        await panda_ws.send(json.dumps({"settings": {"work_on": True}}))
-                        await asyncio.sleep(0.2)
-                except Exception as e:
-                    log_event(f"[POWER-ON-ERR] {e}")
+            dev.state.heating_locked = False
+            dev.state.power_forced_off = False
 
-            asyncio.run_coroutine_threadsafe(power_on(), main_loop)
+            # ON als bool True
+            dev.cmd_queue.submit({"settings": {"work_on": True}})
             return
         
     # TEMPERATUREN & NUMERISCHE SET-WERTE
@@ -467,14 +2034,14 @@ def on_mqtt_message(client, userdata, msg):
         try:
             val = float(val_str)
         except ValueError: return
-        last_ha_change = time.time()
+        dev.state.last_ha_change = time.time()
         if msg.topic.endswith("/dry_temp/set"):
-            current_data["filament_temp"] = int(val)
-            mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/dry_temp", int(val), retain=True)
+            dev.state.filament_temp = int(val)
+            state_pub.publish(f"{dev.prefix}/dry_temp", int(val), retain=True)
             return
         if msg.topic.endswith("/dry_time/set"):
-            current_data["filament_timer"] = int(val)
-            mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/dry_time", int(val), retain=True)
+            dev.state.filament_timer = int(val)
+            state_pub.publish(f"{dev.prefix}/dry_time", int(val), retain=True)
             return
         if msg.topic.endswith("/soll/set"):
             key, data_key = "set_temp", "kammer_soll"
@@ -483,164 +2050,527 @@ def on_mqtt_message(client, userdata, msg):
         elif msg.topic.endswith("/filtertemp/set"):
             key, data_key = "filtertemp", "filtertemp"
         else: return
-        if data_key == "kammer_soll" and current_data.get("slicer_priority_mode", False):
-            ha_memory["kammer_soll"] = val
-            mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/soll", int(current_data.get("kammer_soll", 0)), retain=True)
+        if data_key == "kammer_soll" and dev.state.slicer_priority_mode:
+            dev.state.ha_soll_memory = val
+            state_pub.publish(f"{dev.prefix}/soll", int(dev.state.kammer_soll), retain=True)
             return
-        current_data[data_key] = val
-        if panda_ws:
-            asyncio.run_coroutine_threadsafe(
-                panda_ws.send(json.dumps({"settings": {key: int(val)}})),
-                main_loop
-            )
-        mqtt_client.publish(msg.topic.replace("/set", ""), int(val), retain=True)
+        setattr(dev.state, data_key, val)
+        # Slider-Bursts: wartende Werte werden zu einem Frame zusammengefasst
+        dev.cmd_queue.submit({"settings": {key: int(val)}})
+        state_pub.publish(msg.topic.replace("/set", ""), int(val), retain=True)
     except Exception as e:
         log_event(f"[TEMP-SET-ERR] {e}", force_console=True)
 
+def on_mqtt_connect(client, userdata, flags, reason_code, properties):
+    # CONNACK abgelehnt (Login falsch, nicht autorisiert) → nicht verbunden, paho trennt selbst
+    if reason_code.is_failure:
+        log_event(f"[MQTT-ERR] Verbindung zu {MQTT_BROKER} abgelehnt: {reason_code}", force_console=True)
+        return
+    # Subscribe bei JEDEM Connect (nach Broker-Neustart sind Subscriptions weg)
+    for dev in devices:
+        client.subscribe(f"{dev.prefix}/#")
+    client.subscribe(HA_STATUS_TOPIC)
+    log_event(f"[MQTT] Verbunden mit {MQTT_BROKER} ({reason_code})")
+    startup.mark("mqtt")
+    state_pub.resync("reconnect")
+    ha_discovery.on_mqtt_connect()
+
 def setup_mqtt():
-    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id=f"PandaNative_{PRINTER_SN}")
+    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, client_id=f"PandaNative_{devices[0].sn}")
     client.username_pw_set(MQTT_USER, MQTT_PASS)
     client.on_message = on_mqtt_message
-    client.connect(MQTT_BROKER, 1883, 60)
-    client.subscribe(f"{MQTT_TOPIC_PREFIX}/#")
-    client.loop_start()
+    client.on_connect = on_mqtt_connect
+    # Verbinden erst in main() (nicht beim Import) → Broker down blockiert den Start nicht
     return client
 
-mqtt_client = setup_mqtt()
+# ============================================================
+# ✅ MQTT IM EVENT LOOP (MQTT_LOOP_MODE = "asyncio")
+# ------------------------------------------------------------
+# Statt loop_start() meldet paho seinen Socket über die
+# on_socket_* Callbacks an: lesen per add_reader → loop_read,
+# schreiben per add_writer → loop_write (nur solange paho Daten
+# im Puffer hat). loop_misc (Keepalive/PING) + Reconnect laufen
+# in einem Task. Alle paho Callbacks laufen so im Event Loop.
+# ============================================================
+class AsyncioMqttLoop:
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.connected = asyncio.Event()
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _in_loop(self, fn, *args):
+        # connect()/reconnect() laufen im Worker-Thread (DNS + TCP Connect blockieren sonst den Loop),
+        # die Socket-Callbacks kommen dann von dort → in den Loop übergeben
+        if threading.get_ident() == self.loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._in_loop(self.loop.add_reader, sock, client.loop_read)
+        self._in_loop(self.connected.set)
 
-def setup_mqtt_discovery():
-    base, dev = MQTT_TOPIC_PREFIX, {"identifiers": [PRINTER_SN], "name": "Panda Breath Mod", "model": "V6.8 Final", "manufacturer": "Biqu"}
+    def _on_socket_close(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_reader, sock)
+        self._in_loop(self.loop.remove_writer, sock)
+        self._in_loop(self.connected.clear)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    async def run(self):
+        first = True
+        delay = 1
+        while True:
+            if not self.connected.is_set():
+                try:
+                    if first:
+                        await asyncio.to_thread(self.client.connect, MQTT_BROKER, 1883, 60)
+                    else:
+                        await asyncio.to_thread(self.client.reconnect)
+                    first = False
+                    delay = 1
+                except Exception as e:
+                    # auch ValueError (z.B. leerer / ungültiger MQTT_BROKER nach Config-Reload) → weiter versuchen
+                    log_event(f"[MQTT-ERR] Verbindung fehlgeschlagen: {e} (neuer Versuch in {delay}s)")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+                    continue
+
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                self.connected.clear()
+            await asyncio.sleep(1)
+
+# ============================================================
+# ✅ MQTT STATE PUBLISHER (NUR BEI ÄNDERUNG + KEYFRAMES)
+# ------------------------------------------------------------
+# Merkt sich pro Topic den zuletzt gesendeten Payload und
+# sendet nur, wenn er sich ändert. Alle MQTT_KEYFRAME_INTERVAL
+# Sek. und nach jedem Broker-Reconnect wird der komplette Stand
+# erneut gesendet (Resync). Thread-sicher, weil auch der paho
+# Thread (on_mqtt_connect → resync) darüber publiziert.
+# ============================================================
+class MqttStatePublisher:
+    def __init__(self):
+        self._last = {}  # topic → (payload, retain)
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "suppressed": 0, "keyframes": 0}
+
+    def publish(self, topic, payload, retain=False):
+        payload = str(payload)  # paho sendet int/float ebenfalls als str
+        with self._lock:
+            if self._last.get(topic) == (payload, retain):
+                self.stats["suppressed"] += 1
+                return
+            self._last[topic] = (payload, retain)
+            self.stats["published"] += 1
+        mqtt_client.publish(topic, payload, retain=retain)
+
+    def resync(self, reason="keyframe"):
+        with self._lock:
+            items = list(self._last.items())
+            self.stats["keyframes"] += 1
+            self.stats["published"] += len(items)
+        for topic, (payload, retain) in items:
+            mqtt_client.publish(topic, payload, retain=retain)
+        if items:
+            log_event(f"[MQTT] Resync ({reason}): {len(items)} Topics")
+
+    async def keyframe_loop(self):
+        while True:
+            # 0 = aus (per Config-Reload wieder einschaltbar → nur ruhig weiter prüfen)
+            if MQTT_KEYFRAME_INTERVAL <= 0:
+                await asyncio.sleep(60)
+                continue
+            await asyncio.sleep(MQTT_KEYFRAME_INTERVAL)
+            self.resync()
+            mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/mqtt_stats", json.dumps(self.stats))
+
+state_pub = MqttStatePublisher()
+
+def build_discovery_configs(dev):
+    configs = []
+    # Erstes Gerät behält Namen + IDs (bestehende HA Entitäten), weitere bekommen den Gerätenamen
+    legacy = dev.index == 0
+    ha_name = "Panda Breath Mod" if legacy else f"Panda Breath Mod {dev.name}"
+    base, ha_dev = dev.prefix, {"identifiers": [dev.sn], "name": ha_name, "model": "V6.8 Final", "manufacturer": "Biqu"}
     for sfx, name in [("soll", "Kammer Soll"), ("limit", "Bett Limit"), ("filtertemp", "Filter Fan Activation"), ("dry_temp", "Drying Temp"), ("dry_time", "Drying Time")]:
-        u_id = f"pb_v66_{PRINTER_SN}_{sfx}"
+        u_id = f"pb_v66_{dev.sn}_{sfx}"
         unit = "h" if "time" in sfx else "°C"
         icon = "mdi:fan-clock" if "filter" in sfx else "mdi:thermometer"
-        mqtt_client.publish(f"homeassistant/number/{u_id}/config", json.dumps({
+        configs.append((f"homeassistant/number/{u_id}/config", {
             "name": name, "state_topic": f"{base}/{sfx}", "command_topic": f"{base}/{sfx}/set",
-            "unique_id": u_id, "device": dev, "min": 1, "max": 120 if ("limit" in sfx or "filter" in sfx) else 80,
+            "unique_id": u_id, "device": ha_dev, "min": 1, "max": 120 if ("limit" in sfx or "filter" in sfx) else 80,
             "unit_of_measurement": unit, "icon": icon, "mode": "box"
-        }), retain=True)
+        }))
 
-    mqtt_client.publish(f"homeassistant/sensor/{base}_panda_modus/config", json.dumps({
-        "name": "Panda Modus", "state_topic": f"{base}/panda_modus", "unique_id": f"{PRINTER_SN}_panda_modus", "device": dev, "icon": "mdi:state-machine"
-    }), retain=True)
+    configs.append((f"homeassistant/sensor/{base}_panda_modus/config", {
+        "name": "Panda Modus", "state_topic": f"{base}/panda_modus", "unique_id": f"{dev.sn}_panda_modus", "device": ha_dev, "icon": "mdi:state-machine"
+    }))
        
-    mqtt_client.publish(f"homeassistant/sensor/{base}_kammer_ist/config", json.dumps({
-        "name": "Kammer Ist", "state_topic": f"{base}/ist", "unique_id": f"{PRINTER_SN}_kammer_ist", "unit_of_measurement": "°C", "device_class": "temperature", "device": dev
-    }), retain=True)
+    configs.append((f"homeassistant/sensor/{base}_kammer_ist/config", {
+        "name": "Kammer Ist", "state_topic": f"{base}/ist", "unique_id": f"{dev.sn}_kammer_ist", "unit_of_measurement": "°C", "device_class": "temperature", "device": ha_dev
+    }))
     
     for b in ["manual", "auto", "drying"]:
-        mqtt_client.publish(f"homeassistant/button/pb_v66_{b}/config", json.dumps({
-            "name": f"Panda {b.capitalize()}", "command_topic": f"{base}/{b}/set", "unique_id": f"pb_v66_{b}", "device": dev
-        }), retain=True)
+        b_id = f"pb_v66_{b}" if legacy else f"pb_v66_{dev.sn}_{b}"
+        configs.append((f"homeassistant/button/{b_id}/config", {
+            "name": f"Panda {b.capitalize()}", "command_topic": f"{base}/{b}/set", "unique_id": b_id, "device": ha_dev
+        }))
 
-    mqtt_client.publish(f"homeassistant/sensor/{base}_status/config", json.dumps({
-        "name": "Panda Heiz Status", "state_topic": f"{base}/status", "unique_id": f"pb_v66_{PRINTER_SN}_status", "device": dev, "icon": "mdi:fire-circle"
-    }), retain=True)
+    configs.append((f"homeassistant/sensor/{base}_status/config", {
+        "name": "Panda Heiz Status", "state_topic": f"{base}/status", "unique_id": f"pb_v66_{dev.sn}_status", "device": ha_dev, "icon": "mdi:fire-circle"
+    }))
 
-    mqtt_client.publish(f"homeassistant/binary_sensor/{base}_fan/config", json.dumps({
-        "name": "Panda Filter Lüfter", "state_topic": f"{base}/fan", "unique_id": f"pb_v66_{PRINTER_SN}_fan", "device": dev, "payload_on": "ON", "payload_off": "OFF", "device_class": "fan"
-    }), retain=True)
+    configs.append((f"homeassistant/binary_sensor/{base}_fan/config", {
+        "name": "Panda Filter Lüfter", "state_topic": f"{base}/fan", "unique_id": f"pb_v66_{dev.sn}_fan", "device": ha_dev, "payload_on": "ON", "payload_off": "OFF", "device_class": "fan"
+    }))
 
-    mqtt_client.publish(f"homeassistant/switch/{base}_panda_power/config", json.dumps({
-        "name": "Panda Power", "state_topic": f"{base}/panda_power", "command_topic": f"{base}/panda_power/set", "unique_id": f"{PRINTER_SN}_panda_power_sw", "device": dev, "payload_on": "ON", "payload_off": "OFF", "icon": "mdi:power"
-    }), retain=True)
+    configs.append((f"homeassistant/switch/{base}_panda_power/config", {
+        "name": "Panda Power", "state_topic": f"{base}/panda_power", "command_topic": f"{base}/panda_power/set", "unique_id": f"{dev.sn}_panda_power_sw", "device": ha_dev, "payload_on": "ON", "payload_off": "OFF", "icon": "mdi:power"
+    }))
 
-    mqtt_client.publish(f"homeassistant/switch/{base}_slicer_priority_mode/config", json.dumps({
-        "name": "Slicer Priority Mode", "state_topic": f"{base}/slicer_priority_mode", "command_topic": f"{base}/slicer_priority_mode/set", "unique_id": f"{PRINTER_SN}_slicer_priority_mode_sw", "device": dev, "payload_on": "ON", "payload_off": "OFF", "icon": "mdi:priority-high"
-    }), retain=True)
+    configs.append((f"homeassistant/switch/{base}_slicer_priority_mode/config", {
+        "name": "Slicer Priority Mode", "state_topic": f"{base}/slicer_priority_mode", "command_topic": f"{base}/slicer_priority_mode/set", "unique_id": f"{dev.sn}_slicer_priority_mode_sw", "device": ha_dev, "payload_on": "ON", "payload_off": "OFF", "icon": "mdi:priority-high"
+    }))
 
-    mqtt_client.publish(f"homeassistant/button/{base}_heizung_stop/config", json.dumps({
-        "name": "Heizung Stop", "command_topic": f"{base}/heizung_stop/set", "unique_id": f"{PRINTER_SN}_heizung_stop_btn", "device": dev, "icon": "mdi:radiator-off"
-    }), retain=True)
+    configs.append((f"homeassistant/button/{base}_heizung_stop/config", {
+        "name": "Heizung Stop", "command_topic": f"{base}/heizung_stop/set", "unique_id": f"{dev.sn}_heizung_stop_btn", "device": ha_dev, "icon": "mdi:radiator-off"
+    }))
 
-    mqtt_client.publish(f"homeassistant/sensor/{base}_slicer_soll/config", json.dumps({
-        "name": "Slicer Soll", "state_topic": f"{base}/slicer_soll", "unique_id": f"{PRINTER_SN}_slicer_soll_sns", "device": dev, "unit_of_measurement": "°C", "device_class": "temperature"
-    }), retain=True)
+    configs.append((f"homeassistant/sensor/{base}_slicer_soll/config", {
+        "name": "Slicer Soll", "state_topic": f"{base}/slicer_soll", "unique_id": f"{dev.sn}_slicer_soll_sns", "device": ha_dev, "unit_of_measurement": "°C", "device_class": "temperature"
+    }))
 
-    mqtt_client.publish(f"homeassistant/sensor/{base}_slicer_target_temp/config", json.dumps({
-        "name": "Slicer Target Temp", "state_topic": f"{base}/slicer_target_temp", "unique_id": f"{PRINTER_SN}_slicer_target_temp_sns", "device": dev, "unit_of_measurement": "°C", "device_class": "temperature"
-    }), retain=True)
+    configs.append((f"homeassistant/sensor/{base}_slicer_target_temp/config", {
+        "name": "Slicer Target Temp", "state_topic": f"{base}/slicer_target_temp", "unique_id": f"{dev.sn}_slicer_target_temp_sns", "device": ha_dev, "unit_of_measurement": "°C", "device_class": "temperature"
+    }))
 
-    mqtt_client.publish(f"homeassistant/sensor/{base}_version/config", json.dumps({
-        "name": "Panda Version", "state_topic": f"{base}/version", "unique_id": f"{PRINTER_SN}_panda_version", "device": dev, "icon": "mdi:information-outline"
-    }), retain=True)
+    configs.append((f"homeassistant/sensor/{base}_version/config", {
+        "name": "Panda Version", "state_topic": f"{base}/version", "unique_id": f"{dev.sn}_panda_version", "device": ha_dev, "icon": "mdi:information-outline"
+    }))
 
 # ✅ NEUE ENTITÄTEN FÜR LOCK-SYSTEM
-    mqtt_client.publish(f"homeassistant/sensor/{base}_lock_status/config", json.dumps({
+    configs.append((f"homeassistant/sensor/{base}_lock_status/config", {
         "name": "Panda Lock Status",
         "state_topic": f"{base}/lock_status",
-        "unique_id": f"{PRINTER_SN}_lock_status",
-        "device": dev,
+        "unique_id": f"{dev.sn}_lock_status",
+        "device": ha_dev,
         "icon": "mdi:lock"
-    }), retain=True)
+    }))
 
-    mqtt_client.publish(f"homeassistant/button/{base}_unlock/config", json.dumps({
+    configs.append((f"homeassistant/button/{base}_unlock/config", {
         "name": "Panda Unlock",
         "command_topic": f"{base}/unlock/set",
-        "unique_id": f"{PRINTER_SN}_unlock_btn",
-        "device": dev,
+        "unique_id": f"{dev.sn}_unlock_btn",
+        "device": ha_dev,
         "icon": "mdi:lock-open-variant"
-    }), retain=True)
-    
+    }))
+
+    return configs
+
+# ============================================================
+# ✅ HA DISCOVERY (EINMAL PRO PROZESS + HA BIRTH)
+# ------------------------------------------------------------
+# Früher bei jeder Panda Verbindung ~20 retained Configs → HA hat
+# jedes Mal alle Entitäten neu aufgebaut. Jetzt:
+# - einmal beim ersten MQTT Connect
+# - erneut nur bei HA Birth ("online" auf homeassistant/status)
+# - pro Topic wird ein Hash gemerkt, unveränderte Configs werden
+#   übersprungen (retained liegen sie ja schon im Broker)
+# - nach einem MQTT Reconnect ist der Broker-Stand unbekannt
+#   (Broker evtl. neu gestartet) → Hashes verwerfen, damit der
+#   nächste Birth wieder alles sendet
+# ============================================================
+HA_STATUS_TOPIC = "homeassistant/status"
+
+class HaDiscovery:
+    def __init__(self):
+        self._hashes = {}  # topic → sha1 des Payloads
+        self._lock = threading.Lock()
+        self.published_once = False
+        self.stats = {"sent": 0, "skipped": 0}
+
+    def publish(self, reason):
+        sent = 0
+        with self._lock:
+            configs = [c for dev in devices for c in build_discovery_configs(dev)]
+            for topic, cfg in configs:
+                payload = json.dumps(cfg)
+                digest = hashlib.sha1(payload.encode()).hexdigest()
+                if self._hashes.get(topic) == digest:
+                    self.stats["skipped"] += 1
+                    continue
+                mqtt_client.publish(topic, payload, retain=True)
+                self._hashes[topic] = digest
+                sent += 1
+            self.stats["sent"] += sent
+            self.published_once = True
+        log_event(f"[DISCOVERY] {reason}: {sent} Configs gesendet")
+
+    def on_mqtt_connect(self):
+        if not self.published_once:
+            self.publish("Start")
+        else:
+            with self._lock:
+                self._hashes.clear()
+
+    def on_ha_status(self, payload):
+        if payload.decode(errors="ignore").strip().lower() == "online":
+            self.publish("HA Birth")
+
+ha_discovery = HaDiscovery()
+mqtt_client = setup_mqtt()
 
 # --- WS LOOP (OPTIMIERT: Hält Verbindung bei WiFi-Paketen offen) ---
-async def update_limits_from_ws():
-    global panda_ws, bind_confirmed, bind_warning_shown
-    uri = f"ws://{PANDA_IP}/ws"
+# Ein settings Paket vom Panda WS in den Zustand übernehmen (auch für den Trace-Replay)
+def apply_ws_settings(dev, incoming_settings):
+    # ✅ Bind bestätigt
+    if not dev.state.bind_confirmed:
+        dev.state.bind_confirmed = True
+        dev.state.bind_warning_shown = False
+
+    if any(dev.last_ws_settings.get(k) != v for k, v in incoming_settings.items()):
+        mark_input_changed(dev)  # neue Kammer-Temperatur / Modus vom Panda
+    dev.last_ws_settings.update(incoming_settings)
+    s = dev.last_ws_settings
+
+    # Ist-Temperatur
+    if 'warehouse_temper' in incoming_settings:
+        dev.state.kammer_ist = float(
+            incoming_settings['warehouse_temper']
+        )
+        state_pub.publish(
+            f"{dev.prefix}/ist",
+            incoming_settings['warehouse_temper']
+        )
 
-    while True:
+    # ===== SET_TEMP SYNC =====
+    if 'set_temp' in incoming_settings:
 
-        # 🔒 LOCK HANDLING
-        if global_lock:
+        ws_temp = float(incoming_settings['set_temp'])
+        slicer_active = dev.state.slicer_priority_mode
 
-            try:
-                # Neue frische Verbindung erzwingen
-                async with websockets.connect(f"ws://{PANDA_IP}/ws") as ws:
+        if slicer_active:
+            dev.state.kammer_soll = ws_temp
+            state_pub.publish(
+                f"{dev.prefix}/soll",
+                int(ws_temp),
+                retain=True
+            )
+        else:
+            if (time.time() - dev.state.last_ha_change) > 5.0:
+                dev.state.kammer_soll = ws_temp
+                state_pub.publish(
+                    f"{dev.prefix}/soll",
+                    int(ws_temp),
+                    retain=True
+                )
 
-                    # 1️⃣ BIND (WICHTIG – sonst ignoriert Panda Befehle)
-                    await ws.send(json.dumps({
-                        "printer": {
-                            "ip": HOST_IP,
-                            "sn": PRINTER_SN,
-                            "access_code": ACCESS_CODE
-                        }
-                    }))
+    if 'hotbedtemp' in s:
+        dev.state.bett_limit = float(s['hotbedtemp'])
 
-                    await asyncio.sleep(0.3)
+    if 'filtertemp' in s:
+        dev.state.filtertemp = float(s['filtertemp'])
 
-                    # 2️⃣ HARD POWER OFF (MASTER SWITCH!)
-                    await ws.send(json.dumps({
-                        "settings": {
-                            "work_on": 0,
-                            "work_mode": 0,
-                            "set_temp": 0
-                        }
-                    }))
+    if 'filament_temp' in s:
+        dev.state.filament_temp = int(s['filament_temp'])
 
-                    await asyncio.sleep(0.5)
+    if 'filament_timer' in s:
+        dev.state.filament_timer = int(s['filament_timer'])
 
-            except Exception as e:
-                log_event(f"[LOCK STOP ERROR] {e}")
+    # ===== MODUS =====
 
-            panda_ws = None
-            await asyncio.sleep(2)
-            continue
+    work_mode = s.get("work_mode")
+    work_on = s.get("work_on")
 
-        # ===== NORMALER WS BETRIEB =====
-        try:
-            async with websockets.connect(uri, ping_interval=20) as websocket:
+    if dev.state.global_lock:
+        modus = "LOCKED"
+    else:
+        if work_on in (1, True, "1"):
+            if work_mode == 1:
+                modus = "Automatik"
+            elif work_mode == 2:
+                modus = "Manuell"
+            elif work_mode == 3:
+                modus = "Dry"
+            else:
+                modus = "Standby"
+        else:
+            modus = "Standby"
 
-                log_event(f"[WS] Verbunden mit Panda {PANDA_IP}")
-                panda_ws = websocket
+    if modus != dev.state.last_reported_mode:
+        state_pub.publish(
+            f"{dev.prefix}/panda_modus",
+            modus,
+            retain=True
+        )
+        dev.state.last_reported_mode = modus
 
-                # Nur binden wenn NICHT power_forced_off
-                if not power_forced_off:
+    # ===== MQTT Sync =====
+    if (time.time() - dev.state.last_ha_change) > 8.0:
+
+        if 'filtertemp' in s:
+            state_pub.publish(
+                f"{dev.prefix}/filtertemp",
+                int(s['filtertemp']),
+                retain=True
+            )
+
+        if 'hotbedtemp' in s:
+            state_pub.publish(
+                f"{dev.prefix}/limit",
+                int(s['hotbedtemp']),
+                retain=True
+            )
+
+        if 'work_on' in s:
+
+            ws_is_on = s['work_on'] in (True, 1, "1")
+            now = time.time()
+
+            # Während Pending: nicht zurückflippen
+            if dev.state.desired_power_state is not None and now < dev.state.power_pending_until:
+                p_val = "1" if dev.state.desired_power_state else "0"
+
+                # Sobald bestätigt → Pending löschen
+                if ws_is_on == dev.state.desired_power_state:
+                    dev.state.desired_power_state = None
+                    dev.state.power_pending_until = 0.0
+
+            else:
+                # Normalbetrieb
+                p_val = "0" if dev.state.power_forced_off else ("1" if ws_is_on else "0")
+
+            state_pub.publish(
+                f"{dev.prefix}/work_on",
+                p_val,
+                retain=True
+            )
+
+            state_pub.publish(
+                f"{dev.prefix}/panda_power",
+                "ON" if p_val == "1" else "OFF",
+                retain=True
+            )
+
+        if 'filament_temp' in s:
+            state_pub.publish(
+                f"{dev.prefix}/dry_temp",
+                int(s['filament_temp']),
+                retain=True
+            )
+
+        if 'filament_timer' in s:
+            state_pub.publish(
+                f"{dev.prefix}/dry_time",
+                int(s['filament_timer']),
+                retain=True
+            )
+
+        state_pub.publish(
+            f"{dev.prefix}/slicer_priority_mode",
+            "ON" if dev.state.slicer_priority_mode else "OFF",
+            retain=True
+        )
+
+        state_pub.publish(
+            f"{dev.prefix}/slicer_soll",
+            int(dev.state.slicer_soll),
+            retain=True
+        )
+
+        state_pub.publish(
+            f"{dev.prefix}/slicer_target_temp",
+            int(dev.state.slicer_soll),
+            retain=True
+        )
+
+        state_pub.publish(
+            f"{dev.prefix}/slicer_file",
+            dev.state.last_analyzed_file,
+            retain=True
+        )
+
+# ============================================================
+# ✅ PANDA WS VERBINDUNG (EINE DAUERHAFTE VERBINDUNG)
+# ------------------------------------------------------------
+# Die Verbindung bleibt über Lock/Unlock bestehen (kein Neuaufbau
+# alle 2 Sek. mehr). Im Lock wird nur geprüft: meldet der Panda
+# (Echo / settings) etwas anderes als PANDA_LOCK_SETTINGS, geht
+# der Aus-Befehl erneut raus (max. einmal pro PANDA_ACK_TIMEOUT).
+# Nach dem Unlock holt get_settings den aktuellen Stand.
+# Reconnect: exponentielles Backoff mit Jitter, zurück auf MIN
+# erst nach PANDA_WS_STABLE_TIME Sek. stabiler Verbindung.
+# Statistik (Uptime, Reconnects, Lock-Wiederholungen) → <prefix>/ws_link
+# ============================================================
+PANDA_LOCK_SETTINGS = {"work_on": 0, "work_mode": 0, "set_temp": 0}
+
+def ws_link_snapshot(dev):
+    link = dev.ws_link
+    up = time.monotonic() - link["connected_since"] if link["connected_since"] else 0.0
+    return {
+        "connected": link["connected_since"] is not None,
+        "uptime_s": round(up, 1),
+        "total_uptime_s": round(link["total_uptime"] + up, 1),
+        "connects": link["connects"],
+        "reconnects": max(0, link["connects"] - 1),
+        "lock_resends": link["lock_resends"],
+        "backoff_s": link["backoff_s"],
+        "last_error": link["last_error"]
+    }
+
+def enforce_lock(dev, remote):
+    """Im Lock: gemeldeten Panda-Stand gegen PANDA_LOCK_SETTINGS prüfen, nur bei Abweichung senden."""
+    diff = {k: remote.get(k) for k, v in PANDA_LOCK_SETTINGS.items() if _ws_value(remote.get(k)) != _ws_value(v)}
+    if not diff:
+        return
+    now = time.monotonic()
+    if now - dev.ws_link["lock_sent_at"] < PANDA_ACK_TIMEOUT:
+        return  # Echo vom letzten Aus-Befehl abwarten
+    dev.ws_link["lock_sent_at"] = now
+    dev.ws_link["lock_resends"] += 1
+    log_event(f"[LOCK] {dev.name}: Panda meldet {diff} → Aus-Befehl erneut", force_console=True)
+    dev.cmd_queue.submit({"settings": dict(PANDA_LOCK_SETTINGS)}, lock=True)
+
+async def update_limits_from_ws(dev):
+    link = dev.ws_link
+    delay = PANDA_WS_BACKOFF_MIN
+
+    while True:
+        uri = f"ws://{dev.panda_ip}/ws"
+        started = None
+        try:
+            async with websockets.connect(uri, ping_interval=20) as websocket:
+                started = time.monotonic()
+                link["connected_since"] = started
+                link["connects"] += 1
+                link["backoff_s"] = 0.0
+
+                log_event(f"[WS] {dev.name}: Verbunden mit Panda {dev.panda_ip} (Verbindung #{link['connects']})")
+                startup.mark(f"panda_ws:{dev.name}")
+                dev.panda_ws = websocket
+                metrics.ws_connects.inc(dev.name)
+                metrics.ws_connected.set(1, dev.name)
+                mqtt_client.publish(f"{dev.prefix}/ws_link", json.dumps(ws_link_snapshot(dev)))
+
+                # Binden wenn NICHT power_forced_off (im Lock immer, sonst ignoriert Panda den Aus-Befehl)
+                locked = dev.state.global_lock
+                if locked or not dev.state.power_forced_off:
 
                     await websocket.send(json.dumps({
                         "printer": {
                             "ip": HOST_IP,
-                            "sn": PRINTER_SN,
-                            "access_code": ACCESS_CODE
+                            "sn": dev.sn,
+                            "access_code": dev.access_code
                         }
                     }))
 
@@ -649,433 +2579,1139 @@ async def update_limits_from_ws():
                     }))
 
                 # ⏳ Bind Watchdog starten
-                asyncio.create_task(bind_watchdog())
+                asyncio.create_task(bind_watchdog(dev))
 
+                remote = {}  # zuletzt gemeldeter Panda-Stand (alle Felder zusammengeführt)
                 while True:
                     msg = await websocket.recv()
                     data = json.loads(msg)
 
-                    if global_lock:
+                    # Nur verarbeiten wenn settings enthalten
+                    if 'settings' not in data:
                         continue
 
-                    # Nur verarbeiten wenn settings enthalten
-                    if 'settings' in data:
-
-                        # ✅ Bind bestätigt
-                        if not bind_confirmed:
-                            bind_confirmed = True
-                            bind_warning_shown = False
-
-                        incoming_settings = data['settings']
-                        last_ws_settings.update(incoming_settings)
-                        s = last_ws_settings
-
-                        # Ist-Temperatur
-                        if 'warehouse_temper' in incoming_settings:
-                            current_data["kammer_ist"] = float(
-                                incoming_settings['warehouse_temper']
-                            )
-                            mqtt_client.publish(
-                                f"{MQTT_TOPIC_PREFIX}/ist",
-                                incoming_settings['warehouse_temper']
-                            )
-
-                        # ===== SET_TEMP SYNC =====
-                        if 'set_temp' in incoming_settings:
-
-                            ws_temp = float(incoming_settings['set_temp'])
-                            slicer_active = current_data.get("slicer_priority_mode", False)
-
-                            if slicer_active:
-                                current_data["kammer_soll"] = ws_temp
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/soll",
-                                    int(ws_temp),
-                                    retain=True
-                                )
-                            else:
-                                if (time.time() - last_ha_change) > 5.0:
-                                    current_data["kammer_soll"] = ws_temp
-                                    mqtt_client.publish(
-                                        f"{MQTT_TOPIC_PREFIX}/soll",
-                                        int(ws_temp),
-                                        retain=True
-                                    )
-
-                        if 'hotbedtemp' in s:
-                            current_data["bett_limit"] = float(s['hotbedtemp'])
-
-                        if 'filtertemp' in s:
-                            current_data["filtertemp"] = float(s['filtertemp'])
-
-                        if 'filament_temp' in s:
-                            current_data["filament_temp"] = int(s['filament_temp'])
-
-                        if 'filament_timer' in s:
-                            current_data["filament_timer"] = int(s['filament_timer'])
-
-                        # ===== MODUS =====
-                        global last_reported_mode, mode_change_hint
-
-                        work_mode = s.get("work_mode")
-                        work_on = s.get("work_on")
-
-                        if global_lock:
-                            modus = "LOCKED"
-                        else:
-                            if work_on in (1, True, "1"):
-                                if work_mode == 1:
-                                    modus = "Automatik"
-                                elif work_mode == 2:
-                                    modus = "Manuell"
-                                elif work_mode == 3:
-                                    modus = "Dry"
-                                else:
-                                    modus = "Standby"
-                            else:
-                                modus = "Standby"
-
-                        if modus != last_reported_mode:
-                            mqtt_client.publish(
-                                f"{MQTT_TOPIC_PREFIX}/panda_modus",
-                                modus,
-                                retain=True
-                            )
-                            last_reported_mode = modus
-
-                        # ===== MQTT Sync =====
-                        if (time.time() - last_ha_change) > 8.0:
-
-                            if 'filtertemp' in s:
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/filtertemp",
-                                    int(s['filtertemp']),
-                                    retain=True
-                                )
-
-                            if 'hotbedtemp' in s:
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/limit",
-                                    int(s['hotbedtemp']),
-                                    retain=True
-                                )
-
-                            if 'work_on' in s:
-                                global desired_power_state, power_pending_until
-
-                                ws_is_on = s['work_on'] in (True, 1, "1")
-                                now = time.time()
-
-                                # Während Pending: nicht zurückflippen
-                                if desired_power_state is not None and now < power_pending_until:
-                                    p_val = "1" if desired_power_state else "0"
-
-                                    # Sobald bestätigt → Pending löschen
-                                    if ws_is_on == desired_power_state:
-                                        desired_power_state = None
-                                        power_pending_until = 0.0
-
-                                else:
-                                    # Normalbetrieb
-                                    p_val = "0" if power_forced_off else ("1" if ws_is_on else "0")
-
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/work_on",
-                                    p_val,
-                                    retain=True
-                                )
-
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/panda_power",
-                                    "ON" if p_val == "1" else "OFF",
-                                    retain=True
-                                )
-
-                            if 'filament_temp' in s:
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/dry_temp",
-                                    int(s['filament_temp']),
-                                    retain=True
-                                )
-
-                            if 'filament_timer' in s:
-                                mqtt_client.publish(
-                                    f"{MQTT_TOPIC_PREFIX}/dry_time",
-                                    int(s['filament_timer']),
-                                    retain=True
-                                )
-
-                            mqtt_client.publish(
-                                f"{MQTT_TOPIC_PREFIX}/slicer_priority_mode",
-                                "ON" if current_data.get("slicer_priority_mode", False) else "OFF",
-                                retain=True
-                            )
-
-                            mqtt_client.publish(
-                                f"{MQTT_TOPIC_PREFIX}/slicer_soll",
-                                int(current_data.get("slicer_soll", 0)),
-                                retain=True
-                            )
-
-                            mqtt_client.publish(
-                                f"{MQTT_TOPIC_PREFIX}/slicer_target_temp",
-                                int(current_data.get("slicer_soll", 0)),
-                                retain=True
-                            )
-
-                            mqtt_client.publish(
-                                f"{MQTT_TOPIC_PREFIX}/slicer_file",
-                                current_data.get("last_analyzed_file", ""),
-                                retain=True
-                            )
+                    # Echo für die Befehls-Queue (auch während Lock, Not-Aus wartet darauf)
+                    trace("ws_in", dev, data['settings'])
+                    dev.cmd_queue.on_settings(data['settings'])
+                    remote.update(data['settings'])
 
-                    else:
+                    # 🔒 LOCK: nur durchsetzen, sonst nichts übernehmen
+                    if dev.state.global_lock:
+                        locked = True
+                        enforce_lock(dev, remote)
                         continue
 
+                    if locked:
+                        # Unlock auf derselben Verbindung → frischen Stand holen
+                        locked = False
+                        await websocket.send(json.dumps({"get_settings": 1}))
+
+                    apply_ws_settings(dev, data['settings'])
+
         except Exception as e:
+            link["last_error"] = str(e) or type(e).__name__
             if DEBUG:
                 log_event(f"WS-Error: {e}")
-
-            panda_ws = None
-            await asyncio.sleep(5)
-
-async def bind_watchdog():
-    global bind_confirmed, bind_warning_shown
+            metrics.ws_errors.inc(dev.name)
+        finally:
+            dev.panda_ws = None
+            metrics.ws_connected.set(0, dev.name)
+            if started is not None:
+                link["total_uptime"] += time.monotonic() - started
+                link["connected_since"] = None
+
+        # Backoff: nach stabiler Verbindung wieder klein anfangen, sonst verdoppeln (mit Jitter)
+        if started is not None and time.monotonic() - started >= PANDA_WS_STABLE_TIME:
+            delay = PANDA_WS_BACKOFF_MIN
+        wait = random.uniform(delay / 2, delay)
+        link["backoff_s"] = round(wait, 1)
+        mqtt_client.publish(f"{dev.prefix}/ws_link", json.dumps(ws_link_snapshot(dev)))
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, PANDA_WS_BACKOFF_MAX)
+
+async def bind_watchdog(dev):
 
     await asyncio.sleep(10)
 
-    if not bind_confirmed and not bind_warning_shown:
+    if not dev.state.bind_confirmed and not dev.state.bind_warning_shown:
         log_event("⚠️ Bitte im Panda UI → Bind drücken!", force_console=True)
 
-        mqtt_client.publish(
-            f"{MQTT_TOPIC_PREFIX}/status",
+        state_pub.publish(
+            f"{dev.prefix}/status",
             "Bitte im Panda UI 'Bind' drücken",
             retain=True
         )
 
-        bind_warning_shown = True
+        dev.state.bind_warning_shown = True
         
+# ============================================================
+# ✅ EVENT-GESTEUERTE REGELUNG
+# ------------------------------------------------------------
+# Statt fest alle 2 Sek. rechnet die Regelung neu, sobald sich
+# ein Eingang ändert (Kammer vom Panda WS, Bett-Sensor, Soll/
+# Modus/Lock per MQTT, Slicer). Ändert sich dadurch der Report,
+# senden die Panda Sessions sofort. Gemessen wird die Zeit von
+# der Eingangs-Änderung bis zum gesendeten push_status
+# (<prefix>/control_latency). Heartbeats: CONTROL_HEARTBEAT
+# (Timer wie MIN_SWITCH_TIME / Sensor-Alter) und
+# PANDA_REPORT_KEEPALIVE / _HEARTBEAT (Keepalive für den Panda).
+# ============================================================
+def mark_input_changed(dev):
+    if dev.input_changed_at is None:
+        dev.input_changed_at = time.perf_counter()
+    dev.input_changed.set()
+
+def notify_report(dev, input_at):
+    # Ohne Session keine Messung (sonst zählt die Wartezeit bis zum Connect mit)
+    dev.report_input_at = input_at if dev.sessions else None
+    # Alle wartenden Sessions wecken (jede wartet auf das aktuelle Event-Objekt)
+    dev.report_wakeup.set()
+    dev.report_wakeup = asyncio.Event()
+
+def record_report_latency(dev):
+    input_at, dev.report_input_at = dev.report_input_at, None
+    if input_at is not None:
+        dev.report_latency.record((time.perf_counter() - input_at) * 1000)
+
+def publish_report_stats(dev):
+    now = time.time()
+    if now - dev.report_latency_published >= 10:  # höchstens alle 10 Sek. veröffentlichen
+        dev.report_latency_published = now
+        mqtt_client.publish(f"{dev.prefix}/control_latency", json.dumps(dev.report_latency.summary()))
+        mqtt_client.publish(f"{dev.prefix}/report_stats", json.dumps({"mode": PANDA_REPORT_MODE, **dev.report_stats}))
+
+# ============================================================
+# ✅ GEMEINSAMER BETT-SENSOR (EIN PRODUCER FÜR ALLE SESSIONS)
+# ------------------------------------------------------------
+# Früher lief pro TLS-Verbindung eine eigene HA-Abfrage + Regel-
+# schleife. Jetzt gibt es genau einen Sensor-Task, der den Wert
+# mit Zeitstempel ablegt (dev.bed_reading), und genau eine
+# Regelschleife (dev.control_output). Die Panda Sessions lesen
+# nur noch den letzten Stand. Beides gibt es einmal pro Gerät.
+# ============================================================
+def bed_reading_age(dev):
+    return (time.time() - dev.bed_reading["ts"]) if dev.bed_reading["ts"] else float("inf")
+
+async def bed_sensor_producer(dev):
+    while True:
+        before = (dev.bed_reading["value"], dev.bed_reading["error"] is None)
+        try:
+            dev.bed_reading["value"] = await read_bed_temperature(dev)
+            dev.bed_reading["ts"] = time.time()
+            dev.bed_reading["error"] = None
+            trace("bed", dev, {"v": dev.bed_reading["value"]})
+            startup.mark(f"bed:{dev.name}")
+        except Exception as e:
+            dev.bed_reading["error"] = e
+            trace("bed", dev, {"err": str(e)})
+        if (dev.bed_reading["value"], dev.bed_reading["error"] is None) != before:
+            mark_input_changed(dev)
+
+        # Push-Quellen (HA WS / Moonraker) wecken sofort, REST wartet das Intervall ab
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(dev.bed_pushed.wait(), BED_POLL_INTERVAL)
+        dev.bed_pushed.clear()
+
+# --- LIVE MONITOR (eine Zeile pro Gerät) ---
+terminal_lines = {}
+
+def render_terminal(dev, line):
+    global terminal_cleared
+    if replay_active: return
+    if not terminal_cleared: os.system('clear'); terminal_cleared = True
+
+    if len(devices) == 1:
+        print(f"\r{line}\033[K", end="", flush=True)
+        return
+
+    # Mehrere Geräte: Block mit einer Zeile pro Gerät oben im Terminal
+    terminal_lines[dev.name] = f"[{dev.name}] {line}"
+    block = "\n".join(f"{terminal_lines.get(d.name, f'[{d.name}] ...')}\033[K" for d in devices)
+    print(f"\033[H{block}", end="", flush=True)
+
+# ============================================================
+# ✅ REGLER-MODI (PID / ZEITPROPORTIONAL)
+# ------------------------------------------------------------
+# Der Panda kennt nur AN (bed_target_temper 100) oder AUS. PID
+# und TPC liefern eine Stellgröße 0..1, die im CONTROL_WINDOW
+# als An-Zeit geschaltet wird. An- oder Aus-Zeiten unter
+# MIN_SWITCH_TIME werden auf 0 bzw. das ganze Fenster gerundet.
+# Die Sicherheits-Overrides (Lock, Standby, Sensorfehler,
+# Fertig) bleiben in control_step und setzen den Regler zurück.
+# ============================================================
+class ChamberController:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_err = None
+        self.last_t = None
+        self.duty = 0.0
+        self.window_start = None
+        self.on_time = 0.0
+
+    def update(self, target, ist, now):
+        err = target - ist
+        dt = (now - self.last_t) if self.last_t is not None else 0.0
+
+        if CONTROL_MODE == "pid":
+            p = PID_KP * err
+            d = PID_KD * (err - self.last_err) / dt if dt > 0 and self.last_err is not None else 0.0
+            integral = self.integral + err * dt
+            u = p + PID_KI * integral + d
+            # Anti-Windup: nicht weiter aufintegrieren, wenn der Ausgang schon in der Sättigung steht
+            if not ((u > 1.0 and err > 0) or (u < 0.0 and err < 0)):
+                self.integral = integral
+            u = p + PID_KI * self.integral + d
+        else:
+            u = err / TPC_BAND
+
+        self.last_err, self.last_t = err, now
+        self.duty = min(1.0, max(0.0, u))
+        return self.duty
+
+    def _window_on_time(self):
+        on = self.duty * CONTROL_WINDOW
+        if on < MIN_SWITCH_TIME:
+            return 0.0
+        if CONTROL_WINDOW - on < MIN_SWITCH_TIME:
+            return float(CONTROL_WINDOW)
+        return on
+
+    def heating(self, now):
+        # Neues Fenster → An-Zeit aus der aktuellen Stellgröße festlegen
+        if self.window_start is None or (now - self.window_start) >= CONTROL_WINDOW:
+            self.window_start = now
+            self.on_time = self._window_on_time()
+        elif (now - self.window_start) < self.on_time:
+            # Während der An-Phase darf eine kleinere Stellgröße früher abschalten (min. MIN_SWITCH_TIME an)
+            self.on_time = min(self.on_time, max(self._window_on_time(), MIN_SWITCH_TIME))
+        return (now - self.window_start) < self.on_time
+
+# Aufheiz-Statistik pro Heizphase: Zeit bis Soll + Überschwingen → <prefix>/heatup
+class HeatupTracker:
+    def __init__(self):
+        self.run = None
+
+    def update(self, dev, active, target, ist, now):
+        run = self.run
+        if run is not None and (not active or target != run["target"]):
+            self.finish(dev, "abgebrochen" if run["reached_at"] is None else "ok")
+            run = None
+
+        if not active:
+            return
+
+        if run is None:
+            if ist < target - HEATUP_MIN_DELTA:
+                self.run = {"target": target, "start_temp": ist, "start": now, "reached_at": None, "peak": ist}
+            return
+
+        run["peak"] = max(run["peak"], ist)
+        if run["reached_at"] is None and ist >= target:
+            run["reached_at"] = now
+        elif run["reached_at"] is not None and (now - run["reached_at"]) >= HEATUP_SETTLE_TIME:
+            self.finish(dev, "ok")
+
+    def finish(self, dev, result):
+        run, self.run = self.run, None
+        report = {
+            "mode": CONTROL_MODE,
+            "result": result,
+            "target": run["target"],
+            "start_temp": run["start_temp"],
+            "time_to_target_s": round(run["reached_at"] - run["start"], 1) if run["reached_at"] else None,
+            "overshoot": round(max(0.0, run["peak"] - run["target"]), 2)
+        }
+        log_event(f"[HEATUP] {dev.name}: {report}")
+        mqtt_client.publish(f"{dev.prefix}/heatup", json.dumps(report), retain=True)
+
+# ============================================================
+# ✅ VERLAUF (RINGPUFFER)
+# ------------------------------------------------------------
+# Jeder Regel-Schritt landet in festen array() Spalten (keine
+# Python Objekte pro Eintrag) → Speicher bleibt über Wochen gleich.
+# Abfrage: {prefix}/history/get mit {"seconds": 3600, "buckets": 60}
+# → Antwort auf {prefix}/history, pro Bucket min/max/mean je Spalte
+# (heat/fan: mean = Anteil AN).
+# ============================================================
+class HistoryRing:
+    FIELDS = ("ist", "soll", "bed", "heat", "fan")
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.head = 0   # nächste Schreibposition
+        self.count = 0
+        self.ts = array("d", bytes(8 * size))
+        self.cols = {
+            "ist": array("f", bytes(4 * size)),
+            "soll": array("f", bytes(4 * size)),
+            "bed": array("f", bytes(4 * size)),
+            "heat": array("B", bytes(size)),
+            "fan": array("B", bytes(size))
+        }
+
+    def append(self, ts, ist, soll, bed, heat, fan):
+        i = self.head
+        if self.count:
+            # Zeitstempel nie rückwärts (Uhr-Sprung), sonst klappt die Suche nicht
+            ts = max(ts, self.ts[i - 1])
+        self.ts[i] = ts
+        c = self.cols
+        c["ist"][i], c["soll"][i], c["bed"][i] = ist, soll, bed
+        c["heat"][i], c["fan"][i] = heat, fan
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def _phys(self, k):
+        # logische Position (0 = ältester Eintrag) → Index im Array
+        return (self.head - self.count + k) % self.size
+
+    def _bisect(self, t):
+        # erste logische Position mit ts >= t
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[self._phys(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _slice(self, col, a, b):
+        # logische Positionen [a, b) als ein array (max. zwei Stücke am Umbruch)
+        pa = self._phys(a)
+        end = pa + (b - a)
+        if end <= self.size:
+            return col[pa:end]
+        return col[pa:] + col[:end - self.size]
+
+    def query(self, start, end, buckets):
+        step = (end - start) / buckets
+        edges = [self._bisect(start + k * step) for k in range(buckets)]
+        edges.append(self._bisect(end) if self.count and end < self.ts[self._phys(self.count - 1)] else self.count)
+        out = {"start": round(start, 1), "step": round(step, 2), "samples": self.count, "capacity": self.size, "n": []}
+        for f in self.FIELDS:
+            out[f] = {"min": [], "max": [], "mean": []}
+
+        for a, b in zip(edges, edges[1:]):
+            out["n"].append(b - a)
+            for f in self.FIELDS:
+                r = out[f]
+                if a == b:
+                    r["min"].append(None); r["max"].append(None); r["mean"].append(None)
+                    continue
+                seg = self._slice(self.cols[f], a, b)
+                r["min"].append(round(min(seg), 2))
+                r["max"].append(round(max(seg), 2))
+                r["mean"].append(round(sum(seg) / len(seg), 2))
+        return out
+
+def heat_decision(dev, target, ist, now):
+    """Heiz-Entscheidung ohne Overrides → (target_state, info)."""
+    if CONTROL_MODE == "hysterese":
+        if ist < (target - HYSTERESE):
+            return 85.0, "Heizen..."
+        if ist >= target:
+            return 20.0, "Ziel erreicht"
+        return dev.state.global_heating_state, "Hysterese"
+
+    duty = dev.controller.update(target, ist, now)
+    state_pub.publish(f"{dev.prefix}/heiz_duty", int(round(duty * 100)), retain=True)
+    if dev.controller.heating(now):
+        return 85.0, "Heizen..."
+    return 20.0, "Ziel erreicht" if ist >= target else "Takten"
+
+# --- REGELUNG (eine Instanz pro Gerät) ---
+def control_step(dev):
+
+    # ============================================================
+    # ✅ HA SENSOR ERROR HANDLING (MIT STATUS-FLAG)
+    # ------------------------------------------------------------
+    # Fehler = letzte Messung fehlgeschlagen ODER Wert zu alt.
+    # ============================================================
+    if dev.bed_reading["ts"] == 0.0 and dev.bed_reading["error"] is None:
+        return  # erste Messung läuft noch
+
+    age = bed_reading_age(dev)
+    if dev.bed_reading["error"] is not None or age > BED_MAX_AGE:
+        dev.state.global_heating_state = 20.0  # Sicherheit AUS
+        dev.control_output = None
+        dev.controller.reset()
+        dev.heatup.update(dev, False, 0.0, 0.0, time.time())
+
+        if not dev.state.bed_sensor_error:
+            reason = dev.bed_reading["error"] or f"Wert veraltet ({age:.0f}s)"
+            log_event(f"[BED-SENSOR-ERR] {reason}", force_console=True)
+            state_pub.publish(
+                f"{dev.prefix}/status",
+                "Check Bed Temperatur Sensor",
+                retain=True
+            )
+            dev.state.bed_sensor_error = True
+        return
+
+    bed_ist = dev.bed_reading["value"]
+
+    # Wenn vorher Fehler war → jetzt wieder OK melden
+    if dev.state.bed_sensor_error:
+        log_event("[BED-SENSOR] Verbindung wieder OK", force_console=True)
+        state_pub.publish(
+            f"{dev.prefix}/status",
+            "Bereit",
+            retain=True
+        )
+        dev.state.bed_sensor_error = False
+    # ============================================================
+
+    # 2. Variablen laden
+    target, ist, limit = dev.state.kammer_soll, dev.state.kammer_ist, dev.state.bett_limit
+    f_threshold = dev.state.filtertemp
+    work_mode = int(dev.last_ws_settings.get("work_mode", 0) or 0)
+
+    now = time.time()
+    active = False  # True = Regler arbeitet (kein Override) → Aufheiz-Statistik
+
+    # ============================================================
+    # ✅ GLOBAL LOCK LOGIK (FIXED & STABILE HYSTERESE)
+    # ------------------------------------------------------------
+    if dev.state.global_lock:
+        target_state, info = 20.0, "LOCKED"
+        dev.state.global_heating_state = 20.0
+
+    else:
+        # Standby → alles aus
+        if work_mode == 0:
+            target_state, info = 20.0, "Standby"
+
+        else:
+            target_state = dev.state.global_heating_state
+
+            # =====================================
+            # 🔥 DRY MODE (eigene Logik)
+            # =====================================
+            if work_mode == 3:
+
+                target = float(
+                    dev.last_ws_settings.get("custom_temp", target)
+                )
+
+                remaining = int(
+                    dev.last_ws_settings.get("remaining_seconds", 0)
+                )
+
+                if remaining <= 0:
+                    target_state, info = 20.0, "Fertig"
+
+                else:
+                    target_state, info = heat_decision(dev, target, ist, now)
+                    active = True
+
+            # =====================================
+            # 🔥 AUTO / MANUELL
+            # =====================================
+            else:
+
+                # 🖨️ Druck erkannt (Bett deutlich über Limit)
+                printing = bed_ist > (limit + 5)
+
+                # 🏁 Druck fertig (Bett unter Limit)
+                finished = bed_ist < limit
+
+                # ⏩ Vorheizen für den nächsten Job der Warteschlange: höheres Soll gilt schon
+                # während des laufenden Drucks und auch nach dessen Ende (Bett kalt)
+                preheat = dev.state.preheat_target > 0
+                if preheat:
+                    target = max(float(target), dev.state.preheat_target)
+
+                # 🔥 Heizen / 🎯 Ziel erreicht / 🔄 Hysterese (bzw. PID / TPC)
+                target_state, info = heat_decision(dev, target, ist, now)
+                active = True
+
+                if preheat:
+                    info = f"Vorheizen: {info}"
+
+                # 🛑 Druck fertig → Heizung aus
+                elif work_mode == 1 and finished:
+                    target_state, info = 20.0, "Fertig"
+                    active = False
+
+        # ========================================================
+        # ⏱ SWITCH-TIMER LOGIK
+        # ========================================================
+        time_passed = (time.time() - dev.state.last_switch_time)
+
+        if target_state == 20.0 and dev.state.global_heating_state != 20.0:
+            dev.state.global_heating_state = 20.0
+            dev.state.last_switch_time = time.time()
+
+        elif (
+            target_state != dev.state.global_heating_state
+            and (
+                dev.state.slicer_priority_mode
+                or time_passed > MIN_SWITCH_TIME
+            )    
+        ):
+            dev.state.global_heating_state = target_state
+            dev.state.last_switch_time = time.time()
+
+    if not active:
+        dev.controller.reset()
+    dev.heatup.update(dev, active, float(target), float(ist), now)
+
+    # ============================================================
+    
+    # 4. Lüfter-Logik (Filter Fan)
+    fan_state = "ON" if bed_ist >= f_threshold else "OFF"
+    
+    # 5. Anzeige & MQTT Update
+    sl = int(dev.state.slicer_soll)
+    sl_prio = "SL-PRIO" if dev.state.slicer_priority_mode else "NORMAL"
+    lock_indicator = "⚠️ LOCKED ⚠️" if dev.state.global_lock else "READY"
+    line = f"🟢 {lock_indicator} | Bed:{bed_ist}° | Kammer:{target}/{ist}° | Heiz:{'AN' if dev.state.global_heating_state > 50 else 'AUS'} | Fan:{fan_state} | {info} | {sl_prio}:{sl}°"
+    
+    dev.mode_change_hint = ""
+    render_terminal(dev, line)
+
+    # Status-Entitäten an HA senden
+    state_pub.publish(f"{dev.prefix}/status", info, retain=True)
+    state_pub.publish(f"{dev.prefix}/panda_heiz_status", info, retain=True)
+    state_pub.publish(f"{dev.prefix}/fan", fan_state, retain=True)
+    state_pub.publish(f"{dev.prefix}/version", PANDA_VERSION, retain=True)
+
+    # Stand für die Panda Sessions ablegen
+    dev.control_output = {
+        "kammer_ist": float(ist),
+        "bed_ist": float(bed_ist),
+        "bed_ts": dev.bed_reading["ts"],
+        "heating": dev.state.global_heating_state > 50
+    }
+    dev.history.append(now, float(ist), float(target), float(bed_ist), dev.state.global_heating_state > 50, fan_state == "ON")
+    return info
+
+REPORT_FIELDS = ("kammer_ist", "bed_ist", "heating")
+
+async def heating_control_loop(dev):
+    while True:
+        with contextlib.suppress(asyncio.TimeoutError):
+            # Untergrenze: 0 / negativ (z.B. aus der TOML) würde sonst dauernd neu rechnen
+            await asyncio.wait_for(dev.input_changed.wait(), max(CONTROL_HEARTBEAT, 0.5))
+        dev.input_changed.clear()
+        input_at, dev.input_changed_at = dev.input_changed_at, None
+
+        prev = dev.control_output
+        try:
+            info = control_step(dev)
+            trace("ctl", dev, [dev.state.global_heating_state, info])
+        except Exception as e:
+            log_event(f"[CONTROL-ERR] {e}", force_console=True)
+
+        out = dev.control_output
+        if out is not None and (prev is None or any(out[k] != prev[k] for k in REPORT_FIELDS)):
+            notify_report(dev, input_at)
+
 # --- EMULATION ---
+# ============================================================
+# ✅ MQTT 3.1.1 CODEC (Emulator-Seite, Panda Touch ↔ Fake-Drucker)
+# ------------------------------------------------------------
+# Inkrementeller Parser: TCP liefert beliebige Stücke, feed()
+# sammelt sie in einem bytearray und gibt nur vollständige
+# Pakete zurück (mehrere pro Read oder eins über viele Reads).
+# Encoder schreiben direkt in ein bytearray. Der Topic-Header
+# (Länge + "device/<SN>/report") wird pro SN nur einmal kodiert.
+# ============================================================
+MQTT_CONNECT, MQTT_CONNACK, MQTT_PUBLISH, MQTT_PUBACK = 1, 2, 3, 4
+MQTT_SUBSCRIBE, MQTT_SUBACK, MQTT_UNSUBSCRIBE, MQTT_UNSUBACK = 8, 9, 10, 11
+MQTT_PINGREQ, MQTT_PINGRESP, MQTT_DISCONNECT = 12, 13, 14
+
+MQTT_MAX_PACKET = 256 * 1024  # Schutz gegen kaputte Längenangaben
+
+class MqttProtocolError(Exception):
+    pass
+
+class MqttPacketParser:
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """Neue Bytes anhängen → Liste vollständiger Pakete (typ, flags, body)."""
+        self._buf += data
+        packets = []
+        pos = 0
+        view = memoryview(self._buf)
+        try:
+            while len(view) - pos >= 2:
+                # Remaining Length (1-4 Bytes, 7 Bit pro Byte)
+                rem, mult, i = 0, 1, pos + 1
+                while True:
+                    if i >= len(view):
+                        return packets  # Header noch unvollständig
+                    b = view[i]
+                    i += 1
+                    rem += (b & 0x7F) * mult
+                    if not b & 0x80:
+                        break
+                    mult *= 128
+                    if mult > 128 ** 3:
+                        raise MqttProtocolError("Remaining Length zu lang")
+                if rem > MQTT_MAX_PACKET:
+                    raise MqttProtocolError(f"Paket zu groß ({rem} Bytes)")
+                if i + rem > len(view):
+                    break  # Body noch unvollständig
+
+                packets.append((view[pos] >> 4, view[pos] & 0x0F, bytes(view[i:i + rem])))
+                pos = i + rem
+        finally:
+            view.release()
+            del self._buf[:pos]
+        return packets
+
+def _mqtt_need(body, end, what):
+    # Abgeschnittener Body → Protokollfehler statt IndexError / Müllwerte
+    if end > len(body):
+        raise MqttProtocolError(f"{what}: Paket zu kurz ({len(body)} Bytes)")
+
+def _mqtt_str(body, i):
+    _mqtt_need(body, i + 2, "String-Länge")
+    n = int.from_bytes(body[i:i + 2], "big")
+    _mqtt_need(body, i + 2 + n, "String")
+    return body[i + 2:i + 2 + n].decode(errors="ignore"), i + 2 + n
+
+def decode_connect(body):
+    """CONNECT → (client_id, keepalive Sek.)"""
+    _, i = _mqtt_str(body, 0)  # Protokollname "MQTT"
+    _mqtt_need(body, i + 4, "CONNECT")
+    keepalive = int.from_bytes(body[i + 2:i + 4], "big")  # nach Level + Flags
+    client_id, _ = _mqtt_str(body, i + 4)
+    return client_id, keepalive
+
+def decode_subscribe(body):
+    """SUBSCRIBE → (Packet-ID Bytes, [(topic, qos), ...])"""
+    _mqtt_need(body, 2, "SUBSCRIBE")
+    pid, i, topics = body[:2], 2, []
+    while i < len(body):
+        topic, i = _mqtt_str(body, i)
+        _mqtt_need(body, i + 1, "SUBSCRIBE QoS")
+        topics.append((topic, body[i] & 0x03))
+        i += 1
+    return pid, topics
+
+def decode_publish(flags, body):
+    """PUBLISH → (topic, Packet-ID Bytes oder None, payload)"""
+    topic, i = _mqtt_str(body, 0)
+    pid = None
+    if (flags >> 1) & 0x03:  # QoS 1/2 → Packet-ID folgt
+        _mqtt_need(body, i + 2, "PUBLISH")
+        pid, i = body[i:i + 2], i + 2
+    return topic, pid, body[i:]
+
+def encode_remaining_length(n, out):
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return out
+
+def encode_packet(ptype, body=b"", flags=0):
+    out = bytearray(((ptype << 4) | flags,))
+    encode_remaining_length(len(body), out)
+    out += body
+    return out
+
+MQTT_CONNACK_OK = bytes(encode_packet(MQTT_CONNACK, b"\x00\x00"))
+MQTT_PINGRESP_PKT = bytes(encode_packet(MQTT_PINGRESP))
+
+_topic_headers = {}  # SN → kodierter Topic-Header
+
+def report_topic_header(sn):
+    hdr = _topic_headers.get(sn)
+    if hdr is None:
+        topic = f"device/{sn}/report".encode()
+        hdr = _topic_headers[sn] = len(topic).to_bytes(2, "big") + topic
+    return hdr
+
+def encode_publish(topic_header, payload):
+    out = bytearray(b"\x30")  # PUBLISH, QoS 0
+    encode_remaining_length(len(topic_header) + len(payload), out)
+    out += topic_header
+    out += payload
+    return out
+
+def quantize_temp(v):
+    if PANDA_REPORT_TEMP_STEP <= 0:
+        return float(v)
+    return round(round(v / PANDA_REPORT_TEMP_STEP) * PANDA_REPORT_TEMP_STEP, 2)
+
+def report_fields(out):
+    # Nur diese Werte entscheiden im "delta" Modus, ob ein Report gesendet wird
+    return {
+        "chamber_temper": quantize_temp(out["kammer_ist"]),
+        "bed_temper": quantize_temp(out["bed_ist"]),
+        "bed_target_temper": 100.0 if out["heating"] else 0.0,
+        "gcode_state": "RUNNING" if out["heating"] else "IDLE"
+    }
+
+def build_report_packet(dev, fields):
+    # 6. Report-Paket für den Panda bauen
+    data = {
+        "print": {
+            "command": "push_status",
+            "msg": 1,
+            "sequence_id": str(int(time.time())),
+            "warehouse_temper": fields["chamber_temper"],
+            **fields,
+            "mc_percent": 50
+        }
+    }
+    return encode_publish(report_topic_header(dev.sn), json.dumps(data).encode())
+
+def device_for_session(sub_topic, peer_ip):
+    # 1️⃣ SN aus dem Subscribe-Topic (device/<SN>/report)
+    parts = (sub_topic or "").split("/")
+    if len(parts) >= 2 and parts[1] in devices_by_sn:
+        return devices_by_sn[parts[1]]
+
+    # 2️⃣ Client-Adresse = Panda IP
+    for d in devices:
+        if d.panda_host == peer_ip:
+            return d
+
+    # 3️⃣ Einzelbetrieb: es gibt nur ein Gerät
+    return devices[0] if len(devices) == 1 else None
+
 async def handle_panda(reader, writer):
 
-    global last_switch_time, global_heating_state, terminal_cleared, mode_change_hint, bed_sensor_error
-    setup_mqtt_discovery()
-    log_event("[SERVER] Panda Client verbunden")
+    peer = writer.get_extra_info("peername")
+    peer_ip = peer[0] if peer else "?"
+    log_event(f"[SERVER] Panda Client verbunden ({peer_ip})")
+    parser = MqttPacketParser()
+    dev = None
+    keepalive = 0
+    report_task = None
     try:
-        # Initialer Handshake
-        await reader.read(1024); writer.write(b'\x20\x02\x00\x00'); await writer.drain()
-        sub_data = await reader.read(1024)
-        if sub_data and sub_data[0] == 0x82:
-            writer.write(b'\x90\x03' + sub_data[2:4] + b'\x00'); await writer.drain()
-
-        while not writer.is_closing():
+        while True:
+            # Keepalive: ohne Paket nach 1,5 × Keepalive gilt der Client als weg (MQTT 3.1.1)
+            timeout = keepalive * 1.5 if keepalive else None
             try:
-                # ============================================================
-                # ✅ OPTIMIERUNG: HA REQUEST AUSLAGERN (verhindert TLS-Timeout)
-                # ------------------------------------------------------------
-                # requests.get ist BLOCKIEREND. 
-                # Wenn HA langsam antwortet, friert der TLS Loop ein.
-                # Deshalb wird der Request in einen Thread ausgelagert.
-                # ============================================================
-                loop = asyncio.get_running_loop()
-
-                def fetch_ha():
-                    return requests.get(
-                        HA_URL,
-                        headers={"Authorization": f"Bearer {HA_TOKEN}"},
-                        timeout=2
-                    )
-
-                # ============================================================
-                # ✅ HA SENSOR ERROR HANDLING (MIT STATUS-FLAG)
-                # ============================================================
-                try:
-                    h_resp = await loop.run_in_executor(None, fetch_ha)
-                    bed_ist = float(h_resp.json().get("state", "0"))
-
-                    # Wenn vorher Fehler war → jetzt wieder OK melden
-                    if bed_sensor_error:
-                        log_event("[BED-SENSOR] Verbindung wieder OK", force_console=True)
-                        mqtt_client.publish(
-                            f"{MQTT_TOPIC_PREFIX}/status",
-                            "Bereit",
-                            retain=True
-                        )
-                        bed_sensor_error = False
-
-                except Exception as ha_err:
-                    bed_ist = 0.0
-                    global_heating_state = 20.0  # Sicherheit AUS
-
-                    if not bed_sensor_error:
-                        log_event(f"[BED-SENSOR-ERR] {ha_err}", force_console=True)
-                        mqtt_client.publish(
-                            f"{MQTT_TOPIC_PREFIX}/status",
-                            "Check Bed Temperatur Sensor",
-                            retain=True
-                        )
-                        bed_sensor_error = True
-
-                    await asyncio.sleep(2)
-                    continue
-                # ============================================================
-                
-                # 2. Variablen laden
-                target, ist, limit = current_data["kammer_soll"], current_data["kammer_ist"], current_data["bett_limit"]
-                f_threshold = current_data.get("filtertemp", 30.0)
-                work_mode = int(last_ws_settings.get("work_mode", 0) or 0)
-
-                # ============================================================
-                # ✅ GLOBAL LOCK LOGIK (FIXED & STABILE HYSTERESE)
-                # ------------------------------------------------------------
-                if global_lock:
-                    target_state, info = 20.0, "LOCKED"
-                    global_heating_state = 20.0
+                data = await asyncio.wait_for(reader.read(4096), timeout)
+            except asyncio.TimeoutError:
+                log_event(f"[SERVER] {peer_ip}: Keepalive abgelaufen → Verbindung getrennt")
+                break
+            if not data:
+                break
+
+            for ptype, flags, body in parser.feed(data):
+                if ptype == MQTT_PINGREQ:
+                    writer.write(MQTT_PINGRESP_PKT)
+
+                elif ptype == MQTT_CONNECT:
+                    client_id, keepalive = decode_connect(body)
+                    writer.write(MQTT_CONNACK_OK)
+                    log_event(f"[SERVER] CONNECT {peer_ip} (client_id={client_id}, keepalive={keepalive}s)")
+
+                elif ptype == MQTT_SUBSCRIBE:
+                    pid, topics = decode_subscribe(body)
+                    writer.write(encode_packet(MQTT_SUBACK, pid + bytes(len(topics))))  # alles QoS 0
+
+                    if dev is None:
+                        dev = device_for_session(topics[0][0] if topics else None, peer_ip)
+                        if dev is None:
+                            log_event(f"[SERVER] Kein Gerät für {peer_ip} ({topics}) → Verbindung getrennt", force_console=True)
+                            return
+                        log_event(f"[SERVER] Session {peer_ip} → {dev.name} ({dev.sn})")
+                        report_task = asyncio.create_task(report_session(dev, writer))
+
+                elif ptype == MQTT_UNSUBSCRIBE:
+                    writer.write(encode_packet(MQTT_UNSUBACK, body[:2]))
+
+                elif ptype == MQTT_PUBLISH:
+                    # z.B. device/<SN>/request (pushall, ...) → nur bestätigen + loggen
+                    topic, pid, payload = decode_publish(flags, body)
+                    if pid is not None:
+                        writer.write(encode_packet(MQTT_PUBACK, pid))
+                    if DEBUG: log_event(f"[SERVER] PUBLISH von {peer_ip}: {topic} {payload[:200]!r}")
+
+                elif ptype == MQTT_DISCONNECT:
+                    return
+
+    except (MqttProtocolError, ConnectionError) as e:
+        log_event(f"[SERVER] {peer_ip}: {e}")
+
+    except Exception as e:
+        # z.B. ssl.SSLError beim Lesen → nur diese Verbindung beenden
+        log_event(f"[EMU-LOOP-ERR] {peer_ip}: {e}", force_console=True)
+
+    finally:
+        if report_task is not None:
+            report_task.cancel()
+        writer.close()
+
+async def report_session(dev, writer):
+    dev.sessions += 1
+    try:
+        await report_loop(dev, writer)
+    finally:
+        dev.sessions -= 1
 
+async def report_loop(dev, writer):
+    last_fields, last_sent = None, 0.0
+    while not writer.is_closing():
+        wakeup = dev.report_wakeup
+        interval = PANDA_REPORT_HEARTBEAT
+        try:
+            # Nur den gemeinsamen Stand lesen (kein eigener HA Request pro Session)
+            out = dev.control_output
+            if out is not None:
+                fields = report_fields(out)
+                now = time.monotonic()
+                keepalive_due = (now - last_sent) >= PANDA_REPORT_KEEPALIVE
+
+                if PANDA_REPORT_MODE == "full" or fields != last_fields or keepalive_due:
+                    writer.write(build_report_packet(dev, fields))
+                    t0 = time.perf_counter()
+                    await writer.drain()
+                    metrics.report_drain.observe(time.perf_counter() - t0, dev.name)
+                    trace("report", dev, fields)
+                    dev.report_stats["sent"] += 1
+                    startup.mark("first_push_status")
+                    if fields == last_fields:
+                        dev.report_stats["keepalive"] += 1
+                    last_fields, last_sent = fields, now
+                    record_report_latency(dev)
                 else:
-                    # Standby → alles aus
-                    if work_mode == 0:
-                        target_state, info = 20.0, "Standby"
+                    # Änderung nur im Rauschen → nichts senden
+                    dev.report_stats["suppressed"] += 1
+                    dev.report_input_at = None
 
-                    else:
-                        target_state = global_heating_state
-
-                        # =====================================
-                        # 🔥 DRY MODE (eigene Logik)
-                        # =====================================
-                        if work_mode == 3:
-
-                            target = float(
-                                last_ws_settings.get("custom_temp", target)
-                            )
-
-                            remaining = int(
-                                last_ws_settings.get("remaining_seconds", 0)
-                            )
-
-                            if remaining <= 0:
-                                target_state, info = 20.0, "Fertig"
-
-                            elif ist < (target - HYSTERESE):
-                                target_state, info = 85.0, "Heizen..."
-
-                            elif ist >= target:
-                                target_state, info = 20.0, "Ziel erreicht"
-
-                            else:
-                                info = "Hysterese"
-
-                        # =====================================
-                        # 🔥 AUTO / MANUELL
-                        # =====================================
-                        else:
-
-                            # 🖨️ Druck erkannt (Bett deutlich über Limit)
-                            printing = bed_ist > (limit + 5)
-
-                            # 🏁 Druck fertig (Bett unter Limit)
-                            finished = bed_ist < limit
-
-                            # 🔥 Heizen wenn Kammer zu kalt
-                            if ist < (target - HYSTERESE):
-                                target_state, info = 85.0, "Heizen..."
-
-                            # 🎯 Ziel erreicht
-                            elif ist >= target:
-                                target_state, info = 20.0, "Ziel erreicht"
-
-                            # 🔄 Hysterese Bereich
-                            else:
-                                info = "Hysterese"
-
-                            # 🛑 Druck fertig → Heizung aus
-                            if work_mode == 1 and finished:
-                                target_state, info = 20.0, "Fertig"
-
-                    # ========================================================
-                    # ⏱ SWITCH-TIMER LOGIK
-                    # ========================================================
-                    time_passed = (time.time() - last_switch_time)
-
-                    if target_state == 20.0 and global_heating_state != 20.0:
-                        global_heating_state = 20.0
-                        last_switch_time = time.time()
-
-                    elif (
-                        target_state != global_heating_state
-                        and (
-                            current_data.get("slicer_priority_mode", False)
-                            or time_passed > MIN_SWITCH_TIME
-                        )    
-                    ):
-                        global_heating_state = target_state
-                        last_switch_time = time.time()
-
-                # ============================================================
-                
-                # 4. Lüfter-Logik (Filter Fan)
-                fan_state = "ON" if bed_ist >= f_threshold else "OFF"
-                
-# 5. Anzeige & MQTT Update
-                sl = int(current_data.get("slicer_soll", 0))
-                sl_prio = "SL-PRIO" if current_data.get("slicer_priority_mode", False) else "NORMAL"
-                lock_indicator = "⚠️ LOCKED ⚠️" if global_lock else "READY"
-                line = f"\r🟢 {lock_indicator} | Bed:{bed_ist}° | Kammer:{target}/{ist}° | Heiz:{'AN' if global_heating_state > 50 else 'AUS'} | Fan:{fan_state} | {info} | {sl_prio}:{sl}°"
-                
-                mode_change_hint = ""
-                if not terminal_cleared: os.system('clear'); terminal_cleared = True
-                print(f"{line}\033[K", end="", flush=True)
-
-                # Status-Entitäten an HA senden
-                mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/status", info, retain=True)
-                mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/panda_heiz_status", info, retain=True)
-                mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/fan", fan_state, retain=True)
-                mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/version", PANDA_VERSION, retain=True)
-
-                # 6. Report-Paket für den Panda bauen
-                data = {
-                    "print": {
-                        "command": "push_status",
-                        "msg": 1,
-                        "sequence_id": str(int(time.time())),
-                        "warehouse_temper": float(ist),
-                        "bed_temper": float(bed_ist),
-                        "chamber_temper": float(ist),
-                        "bed_target_temper": 100.0 if global_heating_state > 50 else 0.0,
-                        "gcode_state": "RUNNING" if global_heating_state > 50 else "IDLE",
-                        "mc_percent": 50
-                    }
-                }
-                
-                payload = json.dumps(data).encode()
-                topic = f"device/{PRINTER_SN}/report".encode()
-                vh = len(topic).to_bytes(2, 'big') + topic
-                rem = len(vh) + len(payload)
-
-                # MQTT Variable Length Encoding für das Display-Protokoll
-                pkt = b'\x30'
-                X = rem
-                while X > 0:
-                    eb = X % 128
-                    X //= 128
-                    if X > 0: eb |= 128
-                    pkt += eb.to_bytes(1, 'big')
-
-                writer.write(pkt + vh + payload); await writer.drain()
+                if PANDA_REPORT_MODE != "full":
+                    interval = PANDA_REPORT_KEEPALIVE - (time.monotonic() - last_sent)
 
-            except Exception as e:
-                log_event(f"[EMU-LOOP-ERR] {e}", force_console=True); break
-            
-            await asyncio.sleep(2)
+        except Exception as e:
+            log_event(f"[EMU-LOOP-ERR] {e}", force_console=True); break
+
+        publish_report_stats(dev)
+
+        # Neuer Stand → sofort prüfen, sonst Keepalive / Heartbeat
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(wakeup.wait(), max(interval, 0.1))
 
+# ============================================================
+# ✅ VERBINDUNGS-TASKS (einzeln neu startbar)
+# ------------------------------------------------------------
+# "ws"      = Panda WebSocket (update_limits_from_ws)
+# "printer" = Moonraker WS oder Druckstatus per HTTP (Slicer)
+# HA WebSocket: ein Task pro HA Instanz (ha_ws_tasks).
+# ============================================================
+DEVICE_TASKS = {
+    "ws": lambda dev: update_limits_from_ws(dev),
+    "printer": lambda dev: (
+        moonraker_ws_client(dev) if dev.moonraker_ws or dev.bed_sensor_source == "moonraker"
+        else slicer_auto_parser(dev)
+    )
+}
+
+def start_device_task(dev, name):
+    old = dev.tasks.get(name)
+    if old is not None:
+        old.cancel()
+        if name == "ws":
+            dev.panda_ws = None
+        else:
+            dev.moonraker_state["connected"] = False
+    dev.tasks[name] = asyncio.create_task(DEVICE_TASKS[name](dev))
+
+def start_ha_ws_sensors():
+    # HA WebSocket: eine Verbindung pro HA Instanz, alle "ha_ws" Geräte teilen sie
+    for task in ha_ws_tasks:
+        task.cancel()
+    ha_ws_tasks.clear()
+    groups = {}
+    for dev in devices:
+        dev.ha_ws_state["connected"] = False
+        if dev.bed_sensor_source == "ha_ws":
+            groups.setdefault(ha_ws_endpoint(dev.ha_url)[0], []).append(dev)
+    for uri, devs in groups.items():
+        ha_ws_tasks.append(asyncio.create_task(ha_ws_sensor(uri, devs)))
+
+# ============================================================
+# ✅ CONFIG HOT RELOAD
+# ------------------------------------------------------------
+# config_watch_loop prüft alle CONFIG_WATCH_INTERVAL Sek. die
+# mtime der Datei (Lesen/Parsen im Thread, nicht im Loop).
+# - Regel-Werte, Intervalle, Limits → sofort (werden bei jeder
+#   Verwendung neu gelesen), Regelung rechnet direkt neu
+# - MQTT Broker/Login → nur der MQTT Client verbindet neu
+# - Panda IP / Access Code / HOST_IP → nur der Panda WS des Geräts
+# - Drucker IP / Moonraker → nur der Drucker-Task des Geräts
+# - HA URL / Token / Sensor-Quelle → nur die HA WebSocket Tasks
+# Alles, was beim Start fest verdrahtet wird, braucht einen
+# Neustart (CONFIG_RESTART_KEYS) und bleibt bis dahin alt.
+# ============================================================
+CONFIG_RESTART_KEYS = {
+    "MQTT_LOOP_MODE", "MQTT_TOPIC_PREFIX", "PRINTER_SN", "DEBUG_TO_FILE", "LOG_ROTATE", "LOG_FILE_MAX_MB",
+    "LOG_FILE_BACKUPS", "LOG_JSON", "TRACE_FILE", "HISTORY_SIZE", "METRICS_PORT", "METRICS_BIND",
+    "LOOP_LAG_INTERVAL", "HTTP_MAX_CONCURRENT", "HTTP_LIMIT_PER_HOST", "GCODE_CACHE_FILE", "GCODE_CACHE_SIZE",
+    # Reporter-Tasks starten nur in main() (und 0 ↔ >0 im Betrieb wäre eine Endlos-Schleife)
+    "HTTP_STATS_INTERVAL", "METRICS_MQTT_INTERVAL", "LOG_RATE_LIMIT"
+}
+CONFIG_MQTT_KEYS = {"MQTT_BROKER", "MQTT_USER", "MQTT_PASS"}
+
+async def mqtt_switch_endpoint():
+    log_event(f"[CONFIG] MQTT verbindet neu mit {MQTT_BROKER}", force_console=True)
+    mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
+    if MQTT_LOOP_MODE == "asyncio":
+        # AsyncioMqttLoop.run sieht die Trennung und ruft reconnect() mit dem neuen Host
+        mqtt_client.disconnect()
+        mqtt_client.connect_async(MQTT_BROKER, 1883, 60)
+        return
+
+    def switch():
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+        mqtt_client.connect_async(MQTT_BROKER, 1883, 60)
+        mqtt_client.loop_start()
+    await asyncio.to_thread(switch)
+
+def reconfigure_devices(changed):
+    cfgs = DEVICES or [{"name": "panda"}]
+    if len(cfgs) != len(devices):
+        log_event("[CONFIG] Anzahl der DEVICES geändert → Neustart nötig", force_console=True)
+        return
+
+    restart_ha_ws = bool(changed.keys() & {"HA_TOKEN", "HA_WS_PING_INTERVAL"})
+    for dev, cfg in zip(devices, cfgs):
+        new = device_config(cfg, dev.index)
+        diff = {k for k, v in new.items() if getattr(dev, k) != v}
+        fixed = diff & {"name", "sn", "prefix"}
+        if fixed:
+            log_event(f"[CONFIG] {dev.name}: Neustart nötig für {', '.join(sorted(fixed))}", force_console=True)
+            diff -= fixed
+        for k in diff:
+            setattr(dev, k, new[k])
+        if diff:
+            log_event(f"[CONFIG] {dev.name}: {', '.join(sorted(diff))} geändert", force_console=True)
+
+        if diff & {"panda_ip", "access_code"} or "HOST_IP" in changed:
+            start_device_task(dev, "ws")
+        if diff & {"printer_ip", "moonraker_ws", "bed_sensor_source"}:
+            start_device_task(dev, "printer")
+        if diff & {"ha_url", "bed_sensor_source"}:
+            restart_ha_ws = True
+
+    if restart_ha_ws:
+        start_ha_ws_sensors()
+
+def config_resets_controller(keys):
+    return any(k.startswith(("CONTROL_MODE", "CONTROL_WINDOW", "PID_", "TPC_")) for k in keys)
+
+async def apply_config(data):
+    new, errors = config_overrides(data)
+    for err in errors:
+        log_event(f"[CONFIG] ignoriert: {err}", force_console=True)
+
+    # Aus der Datei entfernte Werte fallen auf den Standard im Skript zurück
+    changed = {k: v for k, v in {**CONFIG_DEFAULTS, **new}.items() if globals()[k] != v}
+    restart = sorted(changed.keys() & CONFIG_RESTART_KEYS)
+    if restart:
+        log_event(f"[CONFIG] Neustart nötig für: {', '.join(restart)} (bis dahin alter Wert)", force_console=True)
+        for k in restart:
+            del changed[k]
+    if not changed:
+        return
+
+    globals().update(changed)
+    log_event(f"[CONFIG] Übernommen: {', '.join(sorted(changed))}", force_console=True)
+    # Regel-Parameter im Trace festhalten (Replay rechnet ab hier mit den neuen Werten)
+    traced = {k: changed[k] for k in TRACE_CONFIG_KEYS if k in changed}
+    if traced:
+        trace("config", None, traced)
+
+    if "DEBUG" in changed:
+        logging.getLogger().setLevel(logging.DEBUG if DEBUG else logging.CRITICAL)
+    if changed.keys() & CONFIG_MQTT_KEYS:
+        await mqtt_switch_endpoint()
+    reconfigure_devices(changed)
+
+    # Regelung sofort mit den neuen Parametern rechnen (PID/TPC Fenster neu beginnen)
+    reset_controller = config_resets_controller(changed)
+    for dev in devices:
+        if reset_controller:
+            dev.controller.reset()
+        mark_input_changed(dev)
+
+async def config_watch_loop():
+    mtime = config_mtime
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        new_mtime = await asyncio.to_thread(read_config_mtime)
+        if new_mtime == mtime:
+            continue
+        mtime = new_mtime
+        try:
+            data = await asyncio.to_thread(read_config_file)
+        except (OSError, ValueError, RuntimeError) as e:
+            log_event(f"[CONFIG-ERR] {CONFIG_FILE}: {e} (alte Werte bleiben)", force_console=True)
+            continue
+        await apply_config(data)
+
+# ============================================================
+# ✅ TRACE REPLAY (schneller als Echtzeit, ohne Netzwerk)
+# ------------------------------------------------------------
+# Spielt die aufgezeichneten Eingänge (ws_in, bed, mqtt_in,
+# slicer) der Reihe nach in dieselbe Logik wie im Betrieb ein
+# und rechnet an jeder "ctl" Zeile control_step neu. "config"
+# Zeilen (Config-Reload) setzen die Regel-Parameter bis zum
+# nächsten Programmstart im Trace. Die Uhr
+# kommt aus dem Trace (ReplayClock ersetzt das time Modul),
+# damit MIN_SWITCH_TIME / Sensor-Alter identisch laufen.
+# Ergebnis: Abweichungen der Entscheidungen + Durchsatz.
+# ============================================================
+class ReplayClock:
+    def __init__(self):
+        self.wall0 = 0.0
+        self.t = 0.0
+
+    def time(self):
+        return self.wall0 + self.t
+
+    def monotonic(self):
+        return self.t
+
+    def perf_counter(self):
+        return self.t
+
+class ReplayMsg:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode()
+
+def reset_device_for_replay(dev):
+    dev.state = DeviceState()
+    dev.last_ws_settings = {}
+    dev.bed_reading = {"value": None, "ts": 0.0, "error": None}
+    dev.control_output = None
+    dev.panda_ws = None  # Befehle gehen nirgendwo hin, nur der Zustand zählt
+    dev.cmd_queue = PandaCommandQueue(dev)
+    dev.controller = ChamberController()
+    dev.heatup = HeatupTracker()
+    dev.history = HistoryRing()
+
+def replay_trace(path):
+    global time, replay_active
+    real_time, clock = time, ReplayClock()
+    time, replay_active = clock, True
+
+    # mqtt_client ist im Replay nie verbunden → publish geht ins Leere
+    by_name = {d.name: d for d in devices}
+    stats = {"events": 0, "decisions": 0, "mismatches": 0, "skipped": 0, "trace_seconds": 0.0}
+    mismatches = []
+    seg_end = 0.0
+    started = real_time.perf_counter()
+    base_config = {k: globals()[k] for k in TRACE_CONFIG_KEYS}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+
+                # Kopfzeile = neuer Programmstart → Zustand zurücksetzen
+                if isinstance(rec, dict):
+                    stats["trace_seconds"] += seg_end
+                    seg_end = 0.0
+                    clock.wall0, clock.t = rec["wall"], 0.0
+                    globals().update(base_config)
+                    for d in devices:
+                        reset_device_for_replay(d)
+                    changed = {k: [v, globals().get(k)] for k, v in rec["config"].items() if globals().get(k) != v}
+                    if changed:
+                        print(f"⚠️ Regel-Parameter weichen vom Trace ab [trace, jetzt]: {changed}")
+                    continue
+
+                t, kind, name, data = rec
+                if kind == "config":
+                    clock.t = seg_end = t
+                    stats["events"] += 1
+                    globals().update({k: v for k, v in data.items() if k in base_config})
+                    if config_resets_controller(data):
+                        for d in devices:
+                            d.controller.reset()
+                    continue
+                dev = by_name.get(name)
+                if dev is None:
+                    stats["skipped"] += 1
+                    continue
+                clock.t = seg_end = t
+                stats["events"] += 1
+
+                if kind == "ws_in":
+                    if not dev.state.global_lock:
+                        apply_ws_settings(dev, data)
+                elif kind == "bed":
+                    if "v" in data:
+                        dev.bed_reading.update(value=data["v"], ts=clock.time(), error=None)
+                    else:
+                        dev.bed_reading["error"] = data["err"]
+                elif kind == "mqtt_in":
+                    if data[0].endswith(REPLAY_SKIP_TOPICS):
+                        stats["skipped"] += 1
+                    else:
+                        handle_device_command(dev, ReplayMsg(*data))
+                elif kind == "slicer":
+                    apply_slicer_target(dev, *data)
+                elif kind == "preheat":
+                    dev.state.preheat_file, dev.state.preheat_target = data[:2]
+                    if len(data) > 2 and data[2] is not None:
+                        dev.state.kammer_soll = data[2]
+                elif kind == "ctl":
+                    info = control_step(dev)
+                    got = [dev.state.global_heating_state, info]
+                    stats["decisions"] += 1
+                    if got != data:
+                        stats["mismatches"] += 1
+                        if len(mismatches) < 20:
+                            mismatches.append({"t": t, "dev": name, "trace": data, "replay": got})
     finally:
-        writer.close()
+        time, replay_active = real_time, False
+        globals().update(base_config)
+
+    stats["trace_seconds"] = round(stats["trace_seconds"] + seg_end, 1)
+    elapsed = time.perf_counter() - started
+    stats["replay_seconds"] = round(elapsed, 3)
+    stats["events_per_s"] = round(stats["events"] / elapsed) if elapsed > 0 else None
+    stats["speedup"] = round(stats["trace_seconds"] / elapsed, 1) if elapsed > 0 else None
+
+    print(f"\n🔁 Replay {path}")
+    for m in mismatches:
+        print(f"   ❌ t={m['t']} {m['dev']}: Trace {m['trace']} ≠ Replay {m['replay']}")
+    print(f"   {json.dumps(stats)}")
+    return stats
 
 async def main():
     global main_loop
     main_loop = asyncio.get_running_loop()
-    asyncio.create_task(update_limits_from_ws())
-    asyncio.create_task(slicer_auto_parser())
+    loop_watchdog.loop_thread = threading.get_ident()
+    if LOOP_LAG_INTERVAL > 0:
+        asyncio.create_task(loop_watchdog.monitor())
+    if config_startup or config_errors:
+        log_event(f"[CONFIG] {CONFIG_FILE}: {', '.join(sorted(config_startup)) or '-'}", force_console=True)
+    for err in config_errors:
+        log_event(f"[CONFIG] ignoriert: {err}", force_console=True)
+    if LOG_RATE_LIMIT > 0:
+        asyncio.create_task(log_limiter.flush_loop())
+    tracer.start()
+
+    await asyncio.to_thread(gcode_cache.load)
+
+    for dev in devices:
+        dev.cmd_queue = PandaCommandQueue(dev)
+        dev.controller = ChamberController()
+        dev.heatup = HeatupTracker()
+        dev.history = HistoryRing()
+
+    # ✅ SCHNELLSTART: zuerst der TLS Server (Panda Touch verbindet sofort), danach
+    # bauen MQTT, Panda WS, Moonraker und HA parallel auf (jeder Task mit eigenem Retry)
     ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     ssl_ctx.load_cert_chain(certfile="cert.pem", keyfile="key.pem")
     
@@ -1084,9 +3720,41 @@ async def main():
     
     server = await asyncio.start_server(handle_panda, '0.0.0.0', 8883, ssl=ssl_ctx)
     log_event(f"[SERVER] TLS Server gestartet auf 8883 (SECLEVEL=0)")
-    print(f"\n🚀 Panda-Logic-Sync {PANDA_VERSION}\n")
+    startup.mark("tls_server")
+
+    if MQTT_LOOP_MODE == "asyncio":
+        asyncio.create_task(AsyncioMqttLoop(mqtt_client).run())
+    else:
+        # paho Thread verbindet im Hintergrund und versucht es selbst erneut
+        mqtt_client.connect_async(MQTT_BROKER, 1883, 60)
+        mqtt_client.loop_start()
+        asyncio.create_task(command_inbox.run())
+
+    # Pro Gerät: eigene WS Verbindung, Slicer-Watcher, Sensor-Producer, Regelung
+    for dev in devices:
+        asyncio.create_task(dev.cmd_queue.run())
+        start_device_task(dev, "ws")
+        start_device_task(dev, "printer")
+        asyncio.create_task(job_queue_preheat(dev))
+        asyncio.create_task(bed_sensor_producer(dev))
+        asyncio.create_task(heating_control_loop(dev))
+
+    start_ha_ws_sensors()
+    if CONFIG_WATCH_INTERVAL > 0:
+        asyncio.create_task(config_watch_loop())
+
+    if HTTP_STATS_INTERVAL > 0:
+        asyncio.create_task(http_stats_reporter())
+    asyncio.create_task(state_pub.keyframe_loop())
+    if METRICS_PORT:
+        await metrics_http_server()
+    if METRICS_MQTT_INTERVAL > 0:
+        asyncio.create_task(metrics_mqtt_reporter())
+    print(f"\n🚀 Panda-Logic-Sync {PANDA_VERSION} ({len(devices)} Gerät(e))\n")
     async with server: await server.serve_forever()
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--replay":
+        sys.exit(1 if replay_trace(sys.argv[2])["mismatches"] else 0)
     try: asyncio.run(main())
     except KeyboardInterrupt: print("\n🛑 Stopp.")